@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+Block compressed danmaku archive
+
+    file   := MAGIC header block*
+    header := u32 length, json info line ({"live_start_time": ..., "room_id": ...})
+    block  := BLOCK_STRUCT(payload length, record count, min timestamp, max timestamp),
+              zlib compressed json payload
+
+A payload stores the records of one commit column by column, user names are
+replaced by indexes into a per-block name table so every block decodes alone.
+
+Both archives and line-delimited json files can get a sidecar time index
+(<path>.idx): INDEX_MAGIC followed by INDEX_STRUCT entries (min timestamp,
+max timestamp, byte offset, byte length, record count) of every block, or of
+every chunk of lines, so a time window only reads the chunks it overlaps.
+"""
+import logging
+import os
+import struct
+import zlib
+from collections import namedtuple
+from typing import Iterator, List
+
+import jsoncodec
+from writer import GroupCommitWriter
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"DMKA\x01"
+LENGTH_STRUCT = struct.Struct(">I")
+BLOCK_STRUCT = struct.Struct(">IIqq")
+BlockHeader = namedtuple(
+    "BlockHeader", ("offset", "length", "count", "first_timestamp", "last_timestamp")
+)
+
+INDEX_MAGIC = b"DMKI\x01"
+INDEX_STRUCT = struct.Struct(">qqQQI")
+IndexEntry = namedtuple(
+    "IndexEntry", ("first_timestamp", "last_timestamp", "offset", "length", "count")
+)
+INDEX_EXT = ".idx"
+
+# keys of a record written by MyBLiveClient
+FIELDS = ("uid", "uname", "font_size", "color", "msg", "timestamp", "msg_type", "mode", "bubble")
+ARCHIVE_EXT = ".dma"
+
+
+def is_archive(path) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def encode_block(records: List[dict], level=6) -> bytes:
+    names = {}
+    columns = {field: [] for field in FIELDS}
+    for record in records:
+        for field in FIELDS:
+            value = record.get(field)
+            if field == "uname":
+                value = names.setdefault(value, len(names))
+            columns[field].append(value)
+    payload = jsoncodec.dumps({"names": list(names), "columns": columns}).encode("utf-8")
+    payload = zlib.compress(payload, level)
+    timestamps = [t for t in columns["timestamp"] if t is not None] or [0]
+    return (
+        BLOCK_STRUCT.pack(len(payload), len(records), min(timestamps), max(timestamps))
+        + payload
+    )
+
+
+def decode_block(payload: bytes) -> List[dict]:
+    data = jsoncodec.loads(zlib.decompress(payload))
+    names = data["names"]
+    columns = data["columns"]
+    columns["uname"] = [names[index] for index in columns["uname"]]
+    fields = list(columns)
+    return [dict(zip(fields, values)) for values in zip(*columns.values())]
+
+
+class ArchiveWriter(GroupCommitWriter):
+    """
+    @description: GroupCommitWriter that turns every commit into one compressed
+    block, so the block size follows max_count, max_bytes and max_delay
+    """
+
+    file_mode = "ab"
+
+    def __init__(self, path, level=6, **kw):
+        if os.path.exists(path):
+            # new blocks must not land behind a block cut short by a crash
+            truncate_incomplete(path)
+        super().__init__(path, **kw)
+        self.level = level
+
+    def write_header(self, info: dict):
+        header = jsoncodec.dumps(info).encode("utf-8")
+        self._file.write(MAGIC + LENGTH_STRUCT.pack(len(header)) + header)
+        self._file.flush()
+
+    def write_record(self, record: dict):
+        self.write(record)
+
+    def _size(self, item) -> int:
+        # rough uncompressed size, only used for the max_bytes threshold
+        return len(item.get("msg") or "") + len(item.get("uname") or "") + 64
+
+    def _encode(self, items: list):
+        return encode_block(items, self.level)
+
+
+class ArchiveReader:
+    """
+    @description: Read the header and blocks of an archive, a block cut short by
+    a crash ends the archive
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("{} is not a danmaku archive".format(path))
+            length_bytes = f.read(LENGTH_STRUCT.size)
+            if len(length_bytes) < LENGTH_STRUCT.size:
+                raise ValueError("{} has a truncated header".format(path))
+            length, = LENGTH_STRUCT.unpack(length_bytes)
+            header = f.read(length)
+            if len(header) < length:
+                raise ValueError("{} has a truncated header".format(path))
+            self.info = jsoncodec.loads(header)
+            self.data_offset = f.tell()
+
+    def iter_blocks(self, verify=False) -> Iterator[BlockHeader]:
+        """
+        :param verify: also decompress every block, so a corrupt block ends the
+            archive like a short one
+        """
+        with open(self.path, "rb") as f:
+            f.seek(0, 2)
+            size = f.tell()
+            offset = self.data_offset
+            while offset < size:
+                f.seek(offset)
+                header = f.read(BLOCK_STRUCT.size)
+                if len(header) < BLOCK_STRUCT.size:
+                    logger.warning(
+                        "Truncated block at {} of {}, ignore the rest".format(offset, self.path)
+                    )
+                    return
+                block = BlockHeader(offset, *BLOCK_STRUCT.unpack(header))
+                if offset + BLOCK_STRUCT.size + block.length > size:
+                    logger.warning(
+                        "Truncated block at {} of {}, ignore the rest".format(offset, self.path)
+                    )
+                    return
+                if verify:
+                    try:
+                        self.read_block(f, block)
+                    except (zlib.error, ValueError, KeyError, IndexError) as e:
+                        logger.warning(
+                            "Corrupt block at {} of {}, ignore the rest: {}".format(
+                                offset, self.path, e
+                            )
+                        )
+                        return
+                yield block
+                offset += BLOCK_STRUCT.size + block.length
+
+    def read_block(self, f, block: BlockHeader) -> List[dict]:
+        f.seek(block.offset + BLOCK_STRUCT.size)
+        return decode_block(f.read(block.length))
+
+    def __iter__(self) -> Iterator[dict]:
+        with open(self.path, "rb") as f:
+            for block in self.iter_blocks():
+                try:
+                    records = self.read_block(f, block)
+                except (zlib.error, ValueError, KeyError, IndexError) as e:
+                    logger.warning(
+                        "Corrupt block at {} of {}, ignore the rest: {}".format(
+                            block.offset, self.path, e
+                        )
+                    )
+                    return
+                yield from records
+
+
+def truncate_incomplete(path) -> int:
+    """
+    @description: Cut an archive after its last complete block, or to empty
+    when even the header is incomplete, so appending continues a valid
+    archive. Returns the removed bytes
+    """
+    size = os.path.getsize(path)
+    if not size:
+        return 0
+    with open(path, "rb") as f:
+        head = f.read(len(MAGIC))
+    if not MAGIC.startswith(head):
+        raise ValueError("{} is not a danmaku archive".format(path))
+    try:
+        reader = ArchiveReader(path)
+        end = reader.data_offset
+        for block in reader.iter_blocks(verify=True):
+            end = block.offset + BLOCK_STRUCT.size + block.length
+    except ValueError:
+        end = 0  # MAGIC or header cut short, the header is written again
+    if end < size:
+        logger.warning(
+            "Truncate {} from {} to {} bytes, drop an incomplete block".format(path, size, end)
+        )
+        os.truncate(path, end)
+    return size - end
+
+
+def index_path(path) -> str:
+    return path + INDEX_EXT
+
+
+def _iter_line_chunks(path, lines_per_chunk) -> Iterator[IndexEntry]:
+    with open(path, "rb") as f:
+        f.readline()  # info line, or the first line of the older files
+        offset = f.tell()
+        timestamps = []
+        while True:
+            line = f.readline()
+            if line.strip():
+                timestamps.append(jsoncodec.loads(line)["timestamp"])
+            if timestamps and (not line or len(timestamps) >= lines_per_chunk):
+                end = f.tell()
+                yield IndexEntry(
+                    min(timestamps), max(timestamps), offset, end - offset, len(timestamps)
+                )
+                offset, timestamps = end, []
+            if not line:
+                return
+
+
+def build_index(path, lines_per_chunk=1000) -> List[IndexEntry]:
+    """
+    @description: Write the sidecar index of an archive or a json lines file
+    """
+    if is_archive(path):
+        entries = [
+            IndexEntry(
+                b.first_timestamp, b.last_timestamp, b.offset,
+                BLOCK_STRUCT.size + b.length, b.count,
+            )
+            for b in ArchiveReader(path).iter_blocks(verify=True)
+        ]
+    else:
+        entries = list(_iter_line_chunks(path, lines_per_chunk))
+    with open(index_path(path), "wb") as f:
+        f.write(INDEX_MAGIC)
+        for entry in entries:
+            f.write(INDEX_STRUCT.pack(*entry))
+    logger.info("Index {} chunks of {}".format(len(entries), path))
+    return entries
+
+
+def read_index(path) -> List[IndexEntry]:
+    """
+    @description: Load the sidecar index, it is rebuilt when missing or older
+    than the file
+    """
+    idx = index_path(path)
+    if not os.path.exists(idx) or os.path.getmtime(idx) < os.path.getmtime(path):
+        return build_index(path)
+    with open(idx, "rb") as f:
+        if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            raise ValueError("{} is not a danmaku index".format(idx))
+        data = f.read()
+    return [IndexEntry(*entry) for entry in INDEX_STRUCT.iter_unpack(data)]
+
+
+def read_range(path, start, end) -> List[dict]:
+    """
+    @description: Records with start <= timestamp < end (absolute millisecond),
+    sorted by timestamp, reading only the chunks that overlap the window
+    """
+    archived = is_archive(path)
+    result = []
+    with open(path, "rb") as f:
+        for entry in read_index(path):
+            if entry.last_timestamp < start or entry.first_timestamp >= end:
+                continue
+            if archived:
+                f.seek(entry.offset + BLOCK_STRUCT.size)
+                records = decode_block(f.read(entry.length - BLOCK_STRUCT.size))
+            else:
+                f.seek(entry.offset)
+                records = [
+                    jsoncodec.loads(line)
+                    for line in f.read(entry.length).splitlines()
+                    if line.strip()
+                ]
+            result.extend(r for r in records if start <= r["timestamp"] < end)
+    result.sort(key=lambda r: r["timestamp"])
+    return result
@@ -0,0 +1,609 @@
+# -*- coding: utf-8 -*-
+"""
+Micro benchmarks for the recording pipeline, see `python benchmark.py -h`
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+import zlib
+from xml.dom import minidom
+
+try:
+    import resource
+except ImportError:  # not on windows
+    resource = None
+
+import blivedm
+import events
+import jsoncodec
+import main as recorder
+import txt2xml
+from blivedm import HEADER_STRUCT, Operation
+from synthetic import (
+    COMPRESSORS,
+    WS_BODY_PROTOCOL_VERSION_BROTLI,
+    WS_BODY_PROTOCOL_VERSION_DEFLATE,
+    WS_BODY_PROTOCOL_VERSION_NORMAL,
+    make_commands,
+    make_danmu_msg,
+    make_frames,
+    percentile,
+)
+
+
+def legacy_parse(data):
+    """
+    The recursive, slice copying parser replaced by blivedm.iter_packets
+    """
+    offset = 0
+    while offset < len(data):
+        try:
+            header = blivedm.HeaderTuple(*HEADER_STRUCT.unpack_from(data, offset))
+        except struct.error:
+            break
+        body = data[offset + HEADER_STRUCT.size: offset + header.pack_len]
+        if (header.operation == Operation.SEND_MSG_REPLY
+                and header.ver == WS_BODY_PROTOCOL_VERSION_DEFLATE):
+            yield from legacy_parse(zlib.decompress(body))
+        else:
+            yield header.operation, body
+        offset += header.pack_len
+
+
+class EagerDanmakuMessage:
+    """
+    The previous blivedm.DanmakuMessage that unpacks every field up front
+    """
+
+    def __init__(self, mode, font_size, color, timestamp, rnd, uid_crc32, msg_type, bubble,
+                 msg, uid, uname, admin, vip, svip, urank, mobile_verify, uname_color,
+                 medal_level, medal_name, runame, room_id, mcolor, special_medal,
+                 user_level, ulevel_color, ulevel_rank, old_title, title, privilege_type):
+        self.mode = mode
+        self.font_size = font_size
+        self.color = color
+        self.timestamp = timestamp
+        self.rnd = rnd
+        self.uid_crc32 = uid_crc32
+        self.msg_type = msg_type
+        self.bubble = bubble
+        self.msg = msg
+        self.uid = uid
+        self.uname = uname
+        self.admin = admin
+        self.vip = vip
+        self.svip = svip
+        self.urank = urank
+        self.mobile_verify = mobile_verify
+        self.uname_color = uname_color
+        self.medal_level = medal_level
+        self.medal_name = medal_name
+        self.runame = runame
+        self.room_id = room_id
+        self.mcolor = mcolor
+        self.special_medal = special_medal
+        self.user_level = user_level
+        self.ulevel_color = ulevel_color
+        self.ulevel_rank = ulevel_rank
+        self.old_title = old_title
+        self.title = title
+        self.privilege_type = privilege_type
+
+    @classmethod
+    def from_command(cls, info):
+        return cls(
+            info[0][1], info[0][2], info[0][3], info[0][4], info[0][5], info[0][7], info[0][9], info[0][10],
+            info[1],
+            *info[2][:8],
+            *(info[3][:6] or (0, '', '', 0, 0, 0)),
+            info[4][0], info[4][2], info[4][3],
+            *info[5][:2],
+            info[7]
+        )
+
+
+def read_recorded_fields(message_cls, infos):
+    """
+    Build every message and read the nine fields MyBLiveClient records
+    """
+    for info in infos:
+        danmaku = message_cls.from_command(info)
+        (danmaku.uid, danmaku.uname, danmaku.font_size, danmaku.color, danmaku.msg,
+         danmaku.timestamp, danmaku.msg_type, danmaku.mode, danmaku.bubble)
+
+
+def keep_messages(message_cls, infos):
+    return [message_cls.from_command(info) for info in infos]
+
+
+def parse_frame(parse, frame):
+    # bodies are released when the frame is done, as in BLiveClient._handle_message
+    count = 0
+    for _, body in parse(frame):
+        count += len(body) > 0
+    return count
+
+
+def run_parser(parse, frames, handle_frame=parse_frame):
+    return sum(handle_frame(parse, frame) for frame in frames)
+
+
+def measure(fn, *args, repeat=5) -> dict:
+    best = float("inf")
+    for _ in range(repeat):
+        time_s = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - time_s)
+    tracemalloc.start()
+    fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": best, "peak_bytes": peak}
+
+
+def bench_parser(args):
+    frames = make_frames(args.frames, args.commands, args.ver)
+    result = {}
+    for name, parse in (("legacy", legacy_parse), ("iter_packets", blivedm.iter_packets)):
+        stat = measure(run_parser, parse, frames, repeat=args.repeat)
+        stat["us_per_frame"] = stat["seconds"] / len(frames) * 10 ** 6
+        result[name] = stat
+    return result
+
+
+def bench_codec(args):
+    """
+    Bytes on the wire and decode time of the same traffic per protocol version
+    """
+    result = {}
+    for ver in sorted(COMPRESSORS):
+        frames = make_frames(args.frames, args.commands, ver)
+        stat = measure(run_parser, blivedm.iter_packets, frames, repeat=args.repeat)
+        stat["us_per_frame"] = stat["seconds"] / len(frames) * 10 ** 6
+        stat["wire_bytes"] = sum(len(frame) for frame in frames)
+        result["protover_{}".format(ver)] = stat
+    if WS_BODY_PROTOCOL_VERSION_BROTLI not in COMPRESSORS:
+        result["protover_3"] = "brotli is not installed"
+    return result
+
+
+def bench_message(args):
+    rnd = random.Random(0)
+    infos = [make_danmu_msg(index, rnd)["info"] for index in range(args.frames * args.commands)]
+    result = {}
+    for name, message_cls in (("eager", EagerDanmakuMessage), ("lazy", blivedm.DanmakuMessage)):
+        stat = measure(read_recorded_fields, message_cls, infos, repeat=args.repeat)
+        stat["ns_per_message"] = stat["seconds"] / len(infos) * 10 ** 9
+        # the lazy message keeps the info list alive, the eager one keeps its fields
+        stat["retained_bytes_per_message"] = measure(
+            keep_messages, message_cls, infos, repeat=1
+        )["peak_bytes"] / len(infos)
+        result[name] = stat
+    return result
+
+
+class CountingClient(blivedm.BLiveClient):
+    """
+    Client whose danmaku handler only counts, to time the dispatcher itself
+    """
+    _COMMAND_HANDLERS = blivedm.BLiveClient._COMMAND_HANDLERS.copy()
+
+    def __init__(self):
+        super().__init__(92613)
+        self.count = 0
+
+    def _on_receive_danmaku(self, danmaku):
+        self.count += 1
+
+
+class AsyncCountingClient(CountingClient):
+    async def _on_receive_danmaku(self, danmaku):
+        self.count += 1
+
+
+async def legacy_handle_command(client, command):
+    """
+    The previous dispatcher, always awaiting and re-parsing cmd
+    """
+    if isinstance(command, list):
+        for one_command in command:
+            await legacy_handle_command(client, one_command)
+        return
+    cmd = command.get("cmd", "")
+    pos = cmd.find(":")
+    if pos != -1:
+        cmd = cmd[:pos]
+    if cmd in client._COMMAND_HANDLERS:
+        handler = client._COMMAND_HANDLERS[cmd]
+        if handler is not None:
+            await handler(client, command)
+
+
+async def dispatch_all(dispatch, client, batches):
+    for batch in batches:
+        await dispatch(client, batch)
+
+
+def bench_dispatch(args):
+    commands = make_commands(args.frames * args.commands)
+    for command in commands:
+        if command["cmd"] == "DANMU_MSG":
+            command["cmd"] = "DANMU_MSG:4:0:2:2:2:0"
+    batches = [
+        commands[i: i + args.commands] for i in range(0, len(commands), args.commands)
+    ]
+
+    async def run():
+        result = {}
+        for name, client_cls, dispatch in (
+            ("legacy", AsyncCountingClient, legacy_handle_command),
+            ("fast_path", CountingClient, blivedm.BLiveClient._handle_command),
+        ):
+            client = client_cls()
+            best = float("inf")
+            try:
+                for _ in range(args.repeat):
+                    time_s = time.perf_counter()
+                    await dispatch_all(dispatch, client, batches)
+                    best = min(best, time.perf_counter() - time_s)
+            finally:
+                await client.close()
+            result[name] = {"ns_per_command": best / len(commands) * 10 ** 9}
+        return result
+
+    return asyncio.get_event_loop().run_until_complete(run())
+
+
+def decode_all(bodies):
+    loads = jsoncodec.loads
+    for body in bodies:
+        loads(body)
+
+
+def encode_all(records):
+    dumps = jsoncodec.dumps
+    for record in records:
+        dumps(record)
+
+
+def bench_json(args):
+    commands = make_commands(args.frames * args.commands)
+    bodies = [json.dumps(command).encode("utf-8") for command in commands]
+    records = [
+        {"uid": 1, "uname": "user", "font_size": 25, "color": 16777215,
+         "msg": command["info"][1], "timestamp": command["info"][0][4], "msg_type": 0,
+         "mode": 1, "bubble": 0}
+        for command in commands if command["cmd"] == "DANMU_MSG"
+    ]
+    total_bytes = sum(len(body) for body in bodies)
+    default_backend = jsoncodec.backend
+    result = {}
+    try:
+        for name in jsoncodec.BACKENDS:
+            jsoncodec.use_backend(name)
+            decode = measure(decode_all, bodies, repeat=args.repeat)["seconds"]
+            encode = measure(encode_all, records, repeat=args.repeat)["seconds"]
+            result[name] = {
+                "decode_msgs_per_sec": len(bodies) / decode,
+                "decode_mb_per_sec": total_bytes / decode / 2 ** 20,
+                "encode_msgs_per_sec": len(records) / encode,
+                "encode_byte_compatible": all(
+                    jsoncodec.dumps(record) == json.dumps(record) for record in records
+                ),
+            }
+    finally:
+        jsoncodec.use_backend(default_backend)
+    return result
+
+
+def legacy_gene_xml(gene, result_path, danmaku_data, clip_start_time=0):
+    """
+    DanmakuGene.gene_xml before streaming: a whole minidom tree, then toprettyxml
+    """
+    doc = minidom.Document()
+    node_i = doc.createElement("i")
+    doc.appendChild(node_i)
+    for node_data in danmaku_data:
+        node_d = doc.createElement("d")
+        appear_time = (
+            int(node_data["timestamp"]) - gene.live_start_time - clip_start_time
+        ) / 1000
+        attr = [appear_time, node_data["mode"], node_data["font_size"], node_data["color"],
+                node_data["timestamp"], 0, 0, 0]
+        node_d.setAttribute("p", ",".join([str(i) for i in attr]))
+        node_d.appendChild(doc.createTextNode(node_data["msg"]))
+        node_i.appendChild(node_d)
+    with open(result_path, "w", encoding="utf-8") as f:
+        f.write(doc.toprettyxml(indent="  "))
+
+
+def legacy_export(gene, zip_path, danmaku_data):
+    # xml written to a temp file, added to the zip then removed
+    xml_path = zip_path + ".xml"
+    with zipfile.ZipFile(zip_path, "w") as f:
+        legacy_gene_xml(gene, xml_path, danmaku_data)
+        f.write(xml_path, "0.xml")
+        os.remove(xml_path)
+
+
+def streaming_export(gene, zip_path, danmaku_data):
+    with zipfile.ZipFile(zip_path, "w") as f:
+        with f.open("0.xml", "w") as entry, io.TextIOWrapper(entry, encoding="utf-8") as text:
+            gene.write_xml(text, danmaku_data)
+
+
+def bench_xml(args):
+    """
+    One episode of every generated danmaku exported into a zip
+    """
+    live_start_time = int(time.time()) * 1000
+    danmaku_data = [
+        {"uid": 1, "uname": "user", "font_size": 25, "color": 16777215,
+         "msg": command["info"][1] + ' <&">', "timestamp": live_start_time + index,
+         "msg_type": 0, "mode": 1, "bubble": 0}
+        for index, command in enumerate(make_commands(args.frames * args.commands))
+        if command["cmd"] == "DANMU_MSG"
+    ]
+    gene = txt2xml.DanmakuGene.__new__(txt2xml.DanmakuGene)
+    gene.live_start_time = live_start_time
+    tmp_dir = tempfile.mkdtemp(prefix="danmaku-bench-")
+    result = {"danmaku": len(danmaku_data)}
+    try:
+        outputs = {}
+        for name, export in (("minidom", legacy_export), ("streaming", streaming_export)):
+            zip_path = os.path.join(tmp_dir, name + ".zip")
+            stat = measure(export, gene, zip_path, danmaku_data, repeat=args.repeat)
+            stat["danmaku_per_sec"] = len(danmaku_data) / stat["seconds"]
+            with zipfile.ZipFile(zip_path) as f:
+                outputs[name] = f.read("0.xml")
+            result[name] = stat
+        result["identical_output"] = outputs["minidom"] == outputs["streaming"]
+    finally:
+        shutil.rmtree(tmp_dir)
+    return result
+
+
+def export_zip(gene, zip_path, time_list, workers):
+    with zipfile.ZipFile(zip_path, "w") as f:
+        file_names = ["{}.xml".format(index) for index in range(len(time_list))]
+        gene.export_zip(f, file_names, time_list, workers)
+
+
+def bench_export(args, parts=20):
+    """
+    A multi-part upload exported serially and by 2, 4 and one per core worker
+    processes, on a single core machine the parallel runs only show the overhead
+    """
+    live_start_time = int(time.time()) * 1000
+    commands = make_commands(args.frames * args.commands)
+    gene = txt2xml.DanmakuGene.__new__(txt2xml.DanmakuGene)
+    gene.live_start_time = live_start_time
+    gene.timeline = None
+    gene.danmaku_data_raw = [
+        {"uid": 1, "uname": "user", "font_size": 25, "color": 16777215,
+         "msg": command["info"][1], "timestamp": live_start_time + index * 10,
+         "msg_type": 0, "mode": 1, "bubble": 0}
+        for index, command in enumerate(commands) if command["cmd"] == "DANMU_MSG"
+    ]
+    part_length = len(commands) * 10 // parts + 1
+    time_list = [(index * part_length, (index + 1) * part_length) for index in range(parts)]
+    tmp_dir = tempfile.mkdtemp(prefix="danmaku-bench-")
+    result = {"danmaku": len(gene.danmaku_data_raw), "parts": parts, "cpus": os.cpu_count()}
+    try:
+        outputs = {}
+        for workers in sorted({1, 2, 4, os.cpu_count() or 1}):
+            zip_path = os.path.join(tmp_dir, "{}.zip".format(workers))
+            best = float("inf")
+            for _ in range(args.repeat):
+                time_s = time.perf_counter()
+                export_zip(gene, zip_path, time_list, workers)
+                best = min(best, time.perf_counter() - time_s)
+            with zipfile.ZipFile(zip_path) as f:
+                outputs[workers] = [f.read(name) for name in f.namelist()]
+            result["workers_{}".format(workers)] = {"seconds": best}
+        result["identical_output"] = all(
+            output == outputs[1] for output in outputs.values()
+        )
+    finally:
+        shutil.rmtree(tmp_dir)
+    return result
+
+
+def load_and_slice(path, columns, time_list):
+    gene = txt2xml.DanmakuGene(path, columns=columns)
+    return [gene.render_xml(*time_range) for time_range in time_list]
+
+
+def bench_loader(args, parts=20):
+    """
+    A recorded json lines file loaded as dicts and as array columns, then
+    sliced into parts episodes
+    """
+    live_start_time = int(time.time())
+    commands = [
+        command for command in make_commands(args.frames * args.commands)
+        if command["cmd"] == "DANMU_MSG"
+    ]
+    tmp_dir = tempfile.mkdtemp(prefix="danmaku-bench-")
+    path = os.path.join(tmp_dir, "danmaku.json")
+    with open(path, "w") as f:
+        f.write(json.dumps({"live_start_time": live_start_time, "room_id": 92613}) + "\n")
+        for index, command in enumerate(commands):
+            info = command["info"]
+            f.write(json.dumps(
+                {"uid": info[2][0], "uname": info[2][1], "font_size": info[0][2],
+                 "color": info[0][3], "msg": info[1],
+                 "timestamp": live_start_time * 1000 + index * 10, "msg_type": info[0][9],
+                 "mode": info[0][1], "bubble": info[0][10]}
+            ) + "\n")
+    part_length = len(commands) * 10 // parts + 1
+    time_list = [(index * part_length, (index + 1) * part_length) for index in range(parts)]
+    result = {"danmaku": len(commands), "file_bytes": os.path.getsize(path)}
+    try:
+        outputs = {}
+        for name, columns in (("dicts", False), ("columns", True)):
+            stat = measure(load_and_slice, path, columns, time_list, repeat=args.repeat)
+            outputs[name] = load_and_slice(path, columns, time_list)
+            gene = txt2xml.DanmakuGene(path, columns=columns)
+            time_s = time.perf_counter()
+            for time_range in time_list:
+                gene.get_danmaku_by_time(*time_range)
+            stat["slice_seconds"] = time.perf_counter() - time_s
+            result[name] = stat
+        result["identical_output"] = outputs["dicts"] == outputs["columns"]
+    finally:
+        shutil.rmtree(tmp_dir)
+    return result
+
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def bench_pipeline(args):
+    """
+    Frames through BLiveClient._handle_message into the MyBLiveClient file writer
+    """
+    frames = make_frames(args.frames, args.commands, args.ver)
+    tmp_dir = tempfile.mkdtemp(prefix="danmaku-bench-")
+
+    recorder.archive_format = args.archive_format
+
+    async def run():
+        client = recorder.MyBLiveClient(92613, int(time.time()), tmp_dir=tmp_dir + "/")
+        latencies = []
+        try:
+            time_s = time.perf_counter()
+            for frame in frames:
+                frame_s = time.perf_counter()
+                await client._handle_message(frame)
+                latencies.append(time.perf_counter() - frame_s)
+            # until the queue thread has written everything
+            await client.queue.aclose()
+            elapsed = time.perf_counter() - time_s
+        finally:
+            await client.queue.aclose()
+            client.writer.close()
+            client.events.close()
+            await client.close()
+        return elapsed, latencies, client.queue.stats()
+
+    try:
+        elapsed, latencies, queue_stats = asyncio.get_event_loop().run_until_complete(run())
+        written_bytes = sum(
+            os.path.getsize(os.path.join(tmp_dir, name)) for name in os.listdir(tmp_dir)
+        )
+        event_bytes = sum(
+            os.path.getsize(os.path.join(tmp_dir, name))
+            for name in os.listdir(tmp_dir) if name.endswith(events.EVENT_EXT)
+        )
+    finally:
+        shutil.rmtree(tmp_dir)
+    latencies.sort()
+    messages = args.frames * args.commands
+    return {
+        "frames": len(frames),
+        "messages": messages,
+        "messages_per_sec": messages / elapsed,
+        "frame_latency_p50_us": percentile(latencies, 0.5) * 10 ** 6,
+        "frame_latency_p99_us": percentile(latencies, 0.99) * 10 ** 6,
+        "written_bytes": written_bytes,
+        "event_bytes": event_bytes,
+        "queue": queue_stats,
+        "peak_rss_bytes": peak_rss_bytes(),
+    }
+
+
+def run_isolated(name, args) -> dict:
+    """
+    One benchmark in a fresh interpreter, so peak_rss_bytes is its own peak
+    and not the one of the benchmarks that ran before it
+    """
+    command = [
+        sys.executable, os.path.abspath(__file__), name,
+        "--frames", str(args.frames),
+        "--commands", str(args.commands),
+        "--repeat", str(args.repeat),
+        "--ver", str(args.ver),
+        "--archive-format", args.archive_format,
+    ]
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(output)[name]
+
+
+BENCHMARKS = {
+    "parser": bench_parser,
+    "codec": bench_codec,
+    "message": bench_message,
+    "json": bench_json,
+    "dispatch": bench_dispatch,
+    "xml": bench_xml,
+    "export": bench_export,
+    "loader": bench_loader,
+    "pipeline": bench_pipeline,
+}
+
+
+def environment(args) -> dict:
+    return {
+        "time": int(time.time()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "json_backend": jsoncodec.backend,
+        "brotli": blivedm.brotli is not None,
+        "frames": args.frames,
+        "commands_per_frame": args.commands,
+        "protover": args.ver,
+        "archive_format": args.archive_format,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "name", choices=sorted(BENCHMARKS) + ["all"],
+        help="benchmark to run, all runs each benchmark in its own process",
+    )
+    parser.add_argument("--frames", type=int, default=2000)
+    parser.add_argument("--commands", type=int, default=20, help="commands per frame")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--ver", type=int, default=WS_BODY_PROTOCOL_VERSION_DEFLATE,
+        choices=[WS_BODY_PROTOCOL_VERSION_NORMAL] + sorted(COMPRESSORS),
+        help="protocol version of generated frames",
+    )
+    parser.add_argument("--archive-format", choices=("jsonl", "block"), default="jsonl",
+                        help="file format written by the pipeline benchmark")
+    parser.add_argument("--output", help="also write the json result to this file")
+    args = parser.parse_args()
+    result = {"environment": environment(args)}
+    if args.name == "all":
+        for name in BENCHMARKS:
+            result[name] = run_isolated(name, args)
+    else:
+        result[args.name] = BENCHMARKS[args.name](args)
+    output = json.dumps(result, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+
+
+if __name__ == "__main__":
+    main()
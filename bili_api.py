@@ -1,11 +1,139 @@
-from typing import List
+from typing import AsyncIterator, List, Optional, Tuple
 import requests as rq
+import asyncio
+import collections
 import json
 import logging
+import os
+import random
+import re
+import threading
 from dataclasses import dataclass
 
+import aiohttp
+
+import jsoncodec
+
 logger = logging.getLogger(__file__)
 
+DANMAKU_URL = "https://api.live.bilibili.com/xlive/web-room/v1/dM/getDMMsgByPlayBackID?rid={}&index={}"
+
+
+class ChunkError(Exception):
+    """
+    a replay chunk could not be fetched or failed the md5 check
+    """
+
+
+class ChunkCache:
+    """
+    Raw getDMMsgByPlayBackID payloads on disk, one file per (rid, index, md5).
+    A chunk whose md5 changed is another file, so an entry never goes stale.
+    The least recently used files are removed once the cache is over max_bytes
+    """
+
+    def __init__(self, path=None, max_bytes=512 * 1024 * 1024):
+        self.path = path or os.getenv("BILI_CHUNK_CACHE", "./cache/chunks/")
+        self.max_bytes = max_bytes
+        os.makedirs(self.path, exist_ok=True)
+        # get and put run in executor threads, the lock guards entries and size
+        self._lock = threading.Lock()
+        # file name -> size, least recently used first
+        self.entries = collections.OrderedDict()
+        files = [entry for entry in os.scandir(self.path) if entry.is_file()]
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in files:
+            if entry.name.endswith(".tmp"):
+                os.remove(entry.path)  # left by an interrupted put
+            else:
+                self.entries[entry.name] = entry.stat().st_size
+        self.size = sum(self.entries.values())
+
+    @staticmethod
+    def key(rid, index, md5) -> str:
+        return re.sub(r"[^0-9A-Za-z_-]", "_", "{}-{}-{}".format(rid, index, md5)) + ".json"
+
+    def get(self, rid, index, md5) -> Optional[bytes]:
+        if not md5:
+            return None
+        name = self.key(rid, index, md5)
+        with self._lock:
+            if name not in self.entries:
+                return None
+        file_path = os.path.join(self.path, name)
+        try:
+            with open(file_path, "rb") as f:
+                data = f.read()
+            os.utime(file_path)  # the mtime orders the entries across runs
+        except FileNotFoundError:
+            self._forget(name)
+            return None
+        with self._lock:
+            if name in self.entries:
+                self.entries.move_to_end(name)
+        return data
+
+    def discard(self, rid, index, md5):
+        """
+        remove an entry, e.g. one that does not decode
+        """
+        name = self.key(rid, index, md5)
+        self._forget(name)
+        try:
+            os.remove(os.path.join(self.path, name))
+        except FileNotFoundError:
+            pass
+
+    def _forget(self, name):
+        with self._lock:
+            self.size -= self.entries.pop(name, 0)
+
+    def put(self, rid, index, md5, data: bytes):
+        if not md5:
+            return  # not content addressed, nothing tells when it changes
+        name = self.key(rid, index, md5)
+        file_path = os.path.join(self.path, name)
+        # a reader sees the old file or the whole new one, never a partial write
+        tmp_path = "{}.{}.tmp".format(file_path, threading.get_ident())
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, file_path)
+        except OSError as e:
+            logger.warning("Fail to cache chunk {}, msg: {}".format(name, e))
+            return
+        evicted = []
+        with self._lock:
+            self.size += len(data) - self.entries.pop(name, 0)
+            self.entries[name] = len(data)
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                old_name, old_size = self.entries.popitem(last=False)
+                self.size -= old_size
+                evicted.append(old_name)
+        for old_name in evicted:
+            try:
+                os.remove(os.path.join(self.path, old_name))
+            except FileNotFoundError:
+                pass
+
+    def load(self, rid, index, md5):
+        """
+        decoded cached response, None on a miss. An entry that does not decode,
+        e.g. cut short by a crash, is removed and counts as a miss
+        """
+        payload = self.get(rid, index, md5)
+        if payload is None:
+            return None
+        try:
+            resp_data = jsoncodec.loads(payload)
+            if resp_data["code"] == 0 and resp_data["data"]["md5"] == md5:
+                return resp_data
+        except (ValueError, KeyError, TypeError):
+            pass
+        logger.warning("Drop broken cached chunk rid: {}, index: {}".format(rid, index))
+        self.discard(rid, index, md5)
+        return None
+
 
 class MappingType:
     def __iter__(self):
@@ -123,35 +251,42 @@ def get_live_info(rid) -> LiveRecordInfo:
         logger.error("Error when get live info, msg: {}".format(e.args))
 
 
+def parse_danmaku_list(resp_data) -> List[Danmaku]:
+    dm_list = []
+    for dm in resp_data["data"]["dm"]["dm_info"]:
+        d = Danmaku(
+            text=dm["text"],
+            nickname=dm["nickname"],
+            msg_type=dm["msg_type"],
+            mobile_verify=dm["mobile_verify"],
+            is_admin=dm["is_admin"],
+            dm_type=dm["dm_type"],
+            dm_mode=dm["dm_mode"],
+            dm_fontsize=dm["dm_fontsize"],
+            dm_color=dm["dm_color"],
+            ts=dm["ts"],
+            uid=dm["uid"],
+        )
+        dm_list.append(d)
+    return dm_list
+
+
 def get_danmaku(
-    rid: str = "R1Vx411w79V", index: int = 0, md5: str = None
+    rid: str = "R1Vx411w79V", index: int = 0, md5: str = None, cache: ChunkCache = None
 ) -> List[Danmaku]:
-    url = "https://api.live.bilibili.com/xlive/web-room/v1/dM/getDMMsgByPlayBackID?rid={}&index={}".format(
-        rid, index
-    )
-    resp = rq.get(url, headers=bilibili_headers())
+    url = DANMAKU_URL.format(rid, index)
+    resp_data = cache.load(rid, index, md5) if cache is not None else None
+    if resp_data is not None:
+        return parse_chunk(rid, index, resp_data)
+    payload = rq.get(url, headers=bilibili_headers()).content
     try:
-        resp_data = resp.json()
+        resp_data = json.loads(payload)
         if resp_data["code"] == 0:
             if md5 and resp_data["data"]["md5"] != md5:
                 raise Exception("Not passing md5 check")
-            dm_list = []
-            for dm in resp_data["data"]["dm"]["dm_info"]:
-                d = Danmaku(
-                    text=dm["text"],
-                    nickname=dm["nickname"],
-                    msg_type=dm["msg_type"],
-                    mobile_verify=dm["mobile_verify"],
-                    is_admin=dm["is_admin"],
-                    dm_type=dm["dm_type"],
-                    dm_mode=dm["dm_mode"],
-                    dm_fontsize=dm["dm_fontsize"],
-                    dm_color=dm["dm_color"],
-                    ts=dm["ts"],
-                    uid=dm["uid"],
-                )
-                dm_list.append(d)
-            return dm_list
+            if cache is not None:
+                cache.put(rid, index, md5, payload)
+            return parse_danmaku_list(resp_data)
     except json.decoder.JSONDecodeError as e:
         logger.error("Error when get live info, msg: {}".format(e.args))
         raise
@@ -163,6 +298,127 @@ def get_danmaku(
         )
 
 
+def parse_chunk(rid, index, resp_data) -> List[Danmaku]:
+    try:
+        return parse_danmaku_list(resp_data)
+    except TypeError:
+        logger.warning(
+            "NoneType warning when fetching rid: {}, index: {}, may just be a blank chunk.".format(
+                rid, index
+            )
+        )
+        return []
+
+
+async def fetch_danmaku(
+    session: aiohttp.ClientSession,
+    rid: str,
+    index: int,
+    md5: str = None,
+    retries: int = 3,
+    backoff: float = 1.0,
+    cache: ChunkCache = None,
+) -> List[Danmaku]:
+    """
+    async get_danmaku, retried with exponential backoff on network errors,
+    bad responses and md5 mismatch. A blank chunk gives an empty list.
+    With a cache, a chunk whose md5 is cached never touches the network
+    """
+    loop = asyncio.get_event_loop()
+    if cache is not None:
+        # the cache is plain file io, keep it off the event loop
+        resp_data = await loop.run_in_executor(None, cache.load, rid, index, md5)
+        if resp_data is not None:
+            return parse_chunk(rid, index, resp_data)
+    url = DANMAKU_URL.format(rid, index)
+    for attempt in range(retries + 1):
+        try:
+            async with session.get(url) as resp:
+                resp.raise_for_status()
+                payload = await resp.read()
+            resp_data = jsoncodec.loads(payload)
+            if resp_data["code"] != 0:
+                raise ChunkError("Return code {}, msg: {}".format(resp_data["code"], resp_data.get("message")))
+            if resp_data["data"] is None:
+                logger.warning(
+                    "Blank chunk when fetching rid: {}, index: {}".format(rid, index)
+                )
+                return []
+            if md5 and resp_data["data"]["md5"] != md5:
+                raise ChunkError("Not passing md5 check")
+            if cache is not None:
+                await loop.run_in_executor(None, cache.put, rid, index, md5, payload)
+            return parse_chunk(rid, index, resp_data)
+        except (
+            aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError, TypeError, ChunkError
+        ) as e:
+            if attempt == retries:
+                raise ChunkError(
+                    "Fail to fetch rid: {}, index: {} after {} attempts, msg: {!r}".format(
+                        rid, index, attempt + 1, e
+                    )
+                ) from e
+            delay = backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            logger.warning(
+                "Error when fetching rid: {}, index: {}, retry in {:.1f}s, msg: {!r}".format(
+                    rid, index, delay, e
+                )
+            )
+            await asyncio.sleep(delay)
+
+
+async def crawl_danmaku(
+    rid: str,
+    index_info: List[Dms],
+    concurrency: int = 8,
+    session: Optional[aiohttp.ClientSession] = None,
+    retries: int = 3,
+    backoff: float = 1.0,
+    timeout: float = 10,
+    cache: ChunkCache = None,
+) -> AsyncIterator[Tuple[Dms, List[Danmaku]]]:
+    """
+    Fetch the chunks of a record with at most concurrency requests in flight
+    over one pooled session, and yield (chunk, danmaku list) in index order as
+    soon as every chunk before it is done. The first chunk that still fails
+    after its retries raises ChunkError
+    """
+    own_session = session is None
+    if own_session:
+        session = aiohttp.ClientSession(
+            headers=bilibili_headers(),
+            connector=aiohttp.TCPConnector(limit=concurrency),
+            timeout=aiohttp.ClientTimeout(total=timeout),
+        )
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(dms: Dms):
+        async with semaphore:
+            return await fetch_danmaku(
+                session, rid, dms.index, dms.md5, retries, backoff, cache
+            )
+
+    chunks = iter(sorted(index_info, key=lambda x: x.index))
+    # chunks fetched ahead of the consumer are bounded, finished ones wait here in order
+    window = collections.deque()
+    try:
+        for dms in chunks:
+            window.append((dms, asyncio.ensure_future(fetch(dms))))
+            if len(window) < concurrency * 2:
+                continue
+            dms, task = window.popleft()
+            yield dms, await task
+        while window:
+            dms, task = window.popleft()
+            yield dms, await task
+    finally:
+        for _, task in window:
+            task.cancel()
+        await asyncio.gather(*(task for _, task in window), return_exceptions=True)
+        if own_session:
+            await session.close()
+
+
 def get_live_record_list(
     room_id: int, page: int = 1, page_size: int = 65
 ) -> List[RecordListItem]:
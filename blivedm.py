@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
-import json
 import logging
 import ssl as ssl_
 import struct
@@ -12,16 +11,29 @@ from typing import *
 
 import aiohttp
 
+import jsoncodec
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 logger = logging.getLogger(__name__)
 
 ROOM_INIT_URL = 'https://api.live.bilibili.com/xlive/web-room/v1/index/getInfoByRoom'
 DANMAKU_SERVER_CONF_URL = 'https://api.live.bilibili.com/xlive/web-room/v1/index/getDanmuInfo'
+WEBSOCKET_URL = 'wss://{host}:{wss_port}/sub'
 
 HEADER_STRUCT = struct.Struct('>I2H2I')
 HeaderTuple = namedtuple('HeaderTuple', ('pack_len', 'raw_header_size', 'ver', 'operation', 'seq_id'))
+POPULARITY_STRUCT = struct.Struct('>I')
 WS_BODY_PROTOCOL_VERSION_NORMAL = 0
 WS_BODY_PROTOCOL_VERSION_INT = 1  # 用于心跳包
 WS_BODY_PROTOCOL_VERSION_DEFLATE = 2
+WS_BODY_PROTOCOL_VERSION_BROTLI = 3
+# 有brotli时使用压缩率更高的版本3，否则回退到zlib
+DEFAULT_PROTOCOL_VERSION = (WS_BODY_PROTOCOL_VERSION_BROTLI if brotli is not None
+                            else WS_BODY_PROTOCOL_VERSION_DEFLATE)
 
 
 # go-common\app\service\main\broadcast\model\operation.go
@@ -53,7 +65,68 @@ class InitError(Exception):
     """初始化失败"""
 
 
+def _info_field(index, sub_index=None, defaults=None):
+    """
+    从弹幕info数组中取值的属性，用到时才取
+    :param defaults: info[index]为空数组时的默认值，例如没有勋章时info[3]为空数组
+    """
+    if sub_index is None:
+        def getter(self):
+            return self._info[index]
+    elif defaults is None:
+        def getter(self):
+            return self._info[index][sub_index]
+    else:
+        def getter(self):
+            values = self._info[index]
+            return values[sub_index] if len(values) > sub_index else defaults[sub_index]
+
+    def setter(self, value):
+        if sub_index is None:
+            self._info[index] = value
+            return
+        values = self._info[index]
+        if defaults is not None and len(values) <= sub_index:
+            values.extend(defaults[len(values):])
+        values[sub_index] = value
+
+    return property(getter, setter)
+
+
+_MEDAL_DEFAULTS = (0, '', '', 0, 0, 0)
+
+
 class DanmakuMessage:
+    # 录制时每条都要读的字段直接存在slot里，其余字段用到时才从info数组中取
+    __slots__ = ('_info', 'mode', 'font_size', 'color', 'timestamp', 'msg_type', 'bubble',
+                 'msg', 'uid', 'uname')
+
+    rnd = _info_field(0, 5)
+    uid_crc32 = _info_field(0, 7)
+
+    admin = _info_field(2, 2)
+    vip = _info_field(2, 3)
+    svip = _info_field(2, 4)
+    urank = _info_field(2, 5)
+    mobile_verify = _info_field(2, 6)
+    uname_color = _info_field(2, 7)
+
+    medal_level = _info_field(3, 0, _MEDAL_DEFAULTS)
+    medal_name = _info_field(3, 1, _MEDAL_DEFAULTS)
+    runame = _info_field(3, 2, _MEDAL_DEFAULTS)
+    room_id = _info_field(3, 3, _MEDAL_DEFAULTS)
+    mcolor = _info_field(3, 4, _MEDAL_DEFAULTS)
+    special_medal = _info_field(3, 5, _MEDAL_DEFAULTS)
+
+    user_level = _info_field(4, 0)
+    ulevel_color = _info_field(4, 2)
+    ulevel_rank = _info_field(4, 3)
+
+    old_title = _info_field(5, 0)
+    title = _info_field(5, 1)
+
+    privilege_type = _info_field(7)
+
     def __init__(self, mode, font_size, color, timestamp, rnd, uid_crc32, msg_type, bubble,
                  msg,
                  uid, uname, admin, vip, svip, urank, mobile_verify, uname_color,
@@ -102,49 +175,41 @@ class DanmakuMessage:
         self.font_size = font_size
         self.color = color
         self.timestamp = timestamp
-        self.rnd = rnd
-        self.uid_crc32 = uid_crc32
         self.msg_type = msg_type
         self.bubble = bubble
-
         self.msg = msg
-
         self.uid = uid
         self.uname = uname
-        self.admin = admin
-        self.vip = vip
-        self.svip = svip
-        self.urank = urank
-        self.mobile_verify = mobile_verify
-        self.uname_color = uname_color
-
-        self.medal_level = medal_level
-        self.medal_name = medal_name
-        self.runame = runame
-        self.room_id = room_id
-        self.mcolor = mcolor
-        self.special_medal = special_medal
-
-        self.user_level = user_level
-        self.ulevel_color = ulevel_color
-        self.ulevel_rank = ulevel_rank
-
-        self.old_title = old_title
-        self.title = title
-
-        self.privilege_type = privilege_type
+        self._info = [
+            [0, mode, font_size, color, timestamp, rnd, 0, uid_crc32, 0, msg_type, bubble],
+            msg,
+            [uid, uname, admin, vip, svip, urank, mobile_verify, uname_color],
+            [medal_level, medal_name, runame, room_id, mcolor, special_medal],
+            [user_level, 0, ulevel_color, ulevel_rank],
+            [old_title, title],
+            0,
+            privilege_type
+        ]
 
     @classmethod
-    def from_command(cls, info: dict):
-        return cls(
-            info[0][1], info[0][2], info[0][3], info[0][4], info[0][5], info[0][7], info[0][9], info[0][10],
-            info[1],
-            *info[2][:8],
-            *(info[3][:6] or (0, '', '', 0, 0, 0)),
-            info[4][0], info[4][2], info[4][3],
-            *info[5][:2],
-            info[7]
-        )
+    def from_command(cls, info: list):
+        """
+        只解析常用字段并保存info数组，其余字段在读取时才解析
+        """
+        self = cls.__new__(cls)
+        self._info = info
+        base = info[0]
+        self.mode = base[1]
+        self.font_size = base[2]
+        self.color = base[3]
+        self.timestamp = base[4]
+        self.msg_type = base[9]
+        self.bubble = base[10]
+        self.msg = info[1]
+        user = info[2]
+        self.uid = user[0]
+        self.uname = user[1]
+        return self
 
 
 class GiftMessage:
@@ -295,8 +360,55 @@ class SuperChatDeleteMessage:
         )
 
 
+_DECOMPRESSORS = {WS_BODY_PROTOCOL_VERSION_DEFLATE: zlib.decompress}
+if brotli is not None:
+    _DECOMPRESSORS[WS_BODY_PROTOCOL_VERSION_BROTLI] = brotli.decompress
+
+
+def iter_packets(data) -> Iterator[Tuple[int, memoryview]]:
+    """
+    遍历一个websocket帧中的所有包，压缩包会被解压后原地展开
+
+    body是原始数据的memoryview，不复制；用显式栈代替递归
+    :param data: websocket帧数据
+    :return: (operation, body) 生成器
+    """
+    header_size = HEADER_STRUCT.size
+    unpack_from = HEADER_STRUCT.unpack_from
+    stack = []
+    view = memoryview(data)
+    offset = 0
+    while True:
+        if offset >= len(view):
+            if not stack:
+                return
+            view, offset = stack.pop()
+            continue
+        try:
+            pack_len, _, ver, operation, _ = unpack_from(view, offset)
+        except struct.error:
+            offset = len(view)
+            continue
+        if pack_len < header_size:
+            # 包长度不合法，丢弃这个缓冲区剩下的部分
+            offset = len(view)
+            continue
+        body = view[offset + header_size: offset + pack_len]
+        offset += pack_len
+        if operation == Operation.SEND_MSG_REPLY and ver in _DECOMPRESSORS:
+            # 先处理解压出来的包，再回到当前缓冲区
+            stack.append((view, offset))
+            view, offset = memoryview(_DECOMPRESSORS[ver](body)), 0
+            continue
+        if operation == Operation.SEND_MSG_REPLY and ver == WS_BODY_PROTOCOL_VERSION_BROTLI:
+            logger.warning('收到brotli压缩包但没有安装brotli，已丢弃')
+            continue
+        yield operation, body
+
+
 class BLiveClient:
-    _COMMAND_HANDLERS: Dict[str, Optional[Callable[['BLiveClient', dict], Awaitable]]] = {
+    # 处理函数返回None时不需要等待，返回awaitable时会被await
+    _COMMAND_HANDLERS: Dict[str, Optional[Callable[['BLiveClient', dict], Optional[Awaitable]]]] = {
         # 收到弹幕
         # go-common\app\service\live\live-dm\service\v1\send.go
         'DANMU_MSG': lambda client, command: client._on_receive_danmaku(
@@ -329,8 +441,13 @@ class BLiveClient:
         _COMMAND_HANDLERS[cmd] = None
     del cmd
 
+    # 服务器地址，可以在子类或实例上覆盖，例如连接本地的fake_server
+    _room_init_url = ROOM_INIT_URL
+    _danmaku_server_conf_url = DANMAKU_SERVER_CONF_URL
+    _websocket_url = WEBSOCKET_URL
+
     def __init__(self, room_id, uid=0, session: aiohttp.ClientSession=None,
-                 heartbeat_interval=30, ssl=True, loop=None):
+                 heartbeat_interval=30, ssl=True, loop=None, protover=DEFAULT_PROTOCOL_VERSION):
         """
         :param room_id: URL中的房间ID，可以为短ID
         :param uid: B站用户ID，0表示未登录
@@ -338,6 +455,7 @@ class BLiveClient:
         :param heartbeat_interval: 发送心跳包的间隔时间（秒）
         :param ssl: True表示用默认的SSLContext验证，False表示不验证，也可以传入SSLContext
         :param loop: 协程事件循环
+        :param protover: 协议版本，2为zlib，3为brotli，没有安装brotli时只能用2
         """
         # 用来init_room的临时房间ID
         self._tmp_room_id = room_id
@@ -368,14 +486,50 @@ class BLiveClient:
                 raise RuntimeError('BLiveClient and session has to use same event loop')
 
         self._heartbeat_interval = heartbeat_interval
+        if protover == WS_BODY_PROTOCOL_VERSION_BROTLI and brotli is None:
+            logger.warning('没有安装brotli，协议版本回退到%d', WS_BODY_PROTOCOL_VERSION_DEFLATE)
+            protover = WS_BODY_PROTOCOL_VERSION_DEFLATE
+        self._protover = protover
         # noinspection PyProtectedMember
         self._ssl = ssl if ssl else ssl_._create_unverified_context()
         self._websocket = None
+        self._reconnect_count = 0
+        self._bytes_received = 0
+        self._bytes_decoded = 0
+        self._command_counts: Dict[str, int] = {}
 
     @property
     def is_running(self):
         return self._future is not None
 
+    @property
+    def reconnect_count(self):
+        """
+        掉线重连的次数
+        """
+        return self._reconnect_count
+
+    @property
+    def bytes_received(self):
+        """
+        收到的websocket帧字节数（压缩后）
+        """
+        return self._bytes_received
+
+    @property
+    def bytes_decoded(self):
+        """
+        解压后的包体字节数
+        """
+        return self._bytes_decoded
+
+    @property
+    def command_counts(self):
+        """
+        收到的命令数，键是原始的cmd（可能带参数）
+        """
+        return self._command_counts
+
     @property
     def room_id(self):
         """
@@ -435,13 +589,13 @@ class BLiveClient:
 
     async def init_room(self):
         try:
-            async with self._session.get(ROOM_INIT_URL, params={'room_id': self._tmp_room_id},
+            async with self._session.get(self._room_init_url, params={'room_id': self._tmp_room_id},
                                          ssl=self._ssl) as res:
                 if res.status != 200:
                     logger.warning('room %d init_room失败：%d %s', self._tmp_room_id,
                                    res.status, res.reason)
                     return False
-                data = await res.json()
+                data = await res.json(loads=jsoncodec.loads)
                 if data['code'] != 0:
                     logger.warning('room %d init_room失败：%s', self._tmp_room_id, data['msg'])
                     return False
@@ -452,13 +606,13 @@ class BLiveClient:
             return False
 
         try:
-            async with self._session.get(DANMAKU_SERVER_CONF_URL, params={'id': self._room_id, 'type': 0},
+            async with self._session.get(self._danmaku_server_conf_url, params={'id': self._room_id, 'type': 0},
                                          ssl=self._ssl) as res:
                 if res.status != 200:
                     logger.warning('room %d getConf失败：%d %s', self._room_id,
                                    res.status, res.reason)
                     return False
-                data = await res.json()
+                data = await res.json(loads=jsoncodec.loads)
                 if data['code'] != 0:
                     logger.warning('room %d getConf失败：%s', self._room_id, data['msg'])
                     return False
@@ -480,7 +634,7 @@ class BLiveClient:
         return True
 
     def _make_packet(self, data, operation):
-        body = json.dumps(data).encode('utf-8')
+        body = jsoncodec.dumps(data).encode('utf-8')
         header = HEADER_STRUCT.pack(
             HEADER_STRUCT.size + len(body),
             HEADER_STRUCT.size,
@@ -494,7 +648,7 @@ class BLiveClient:
         auth_params = {
             'uid':       self._uid,
             'roomid':    self._room_id,
-            'protover':  2,
+            'protover':  self._protover,
             'platform':  'web',
             'clientver': '1.14.3',
             'type':      2,
@@ -515,7 +669,7 @@ class BLiveClient:
                 # 连接
                 host_server = self._host_server_list[retry_count % len(self._host_server_list)]
                 async with self._session.ws_connect(
-                    f'wss://{host_server["host"]}:{host_server["wss_port"]}/sub',
+                    self._websocket_url.format(**host_server),
                     ssl=self._ssl
                 ) as websocket:
                     self._websocket = websocket
@@ -561,7 +715,9 @@ class BLiveClient:
                 self._websocket = None
 
             retry_count += 1
+            self._reconnect_count += 1
             logger.warning('room %d 掉线重连中%d', self.room_id, retry_count)
+            self._on_disconnect(retry_count)
             try:
                 await asyncio.sleep(1)
             except asyncio.CancelledError:
@@ -577,60 +733,78 @@ class BLiveClient:
                 break
 
     async def _handle_message(self, data):
-        offset = 0
-        while offset < len(data):
-            try:
-                header = HeaderTuple(*HEADER_STRUCT.unpack_from(data, offset))
-            except struct.error:
-                break
-
-            if header.operation == Operation.HEARTBEAT_REPLY:
-                popularity = int.from_bytes(data[offset + HEADER_STRUCT.size:
-                                                 offset + HEADER_STRUCT.size + 4],
-                                            'big')
+        self._bytes_received += len(data)
+        for operation, body in iter_packets(data):
+            self._bytes_decoded += len(body)
+            if operation == Operation.HEARTBEAT_REPLY:
+                if len(body) >= POPULARITY_STRUCT.size:
+                    popularity = POPULARITY_STRUCT.unpack_from(body)[0]
+                else:
+                    # 包体不足4字节时和原来的int.from_bytes一样，空包体是0
+                    popularity = int.from_bytes(body, 'big')
                 await self._on_receive_popularity(popularity)
 
-            elif header.operation == Operation.SEND_MSG_REPLY:
-                body = data[offset + HEADER_STRUCT.size: offset + header.pack_len]
-                if header.ver == WS_BODY_PROTOCOL_VERSION_DEFLATE:
-                    body = zlib.decompress(body)
-                    await self._handle_message(body)
-                else:
-                    try:
-                        body = json.loads(body.decode('utf-8'))
-                        await self._handle_command(body)
-                    except BaseException:
-                        logger.error('body: %s', body)
-                        raise
+            elif operation == Operation.SEND_MSG_REPLY:
+                try:
+                    command = jsoncodec.loads(body)
+                    await self._handle_command(command)
+                except BaseException:
+                    logger.error('body: %s', bytes(body))
+                    raise
 
-            elif header.operation == Operation.AUTH_REPLY:
+            elif operation == Operation.AUTH_REPLY:
                 await self._websocket.send_bytes(self._make_packet({}, Operation.HEARTBEAT))
 
             else:
-                body = data[offset + HEADER_STRUCT.size: offset + header.pack_len]
-                logger.warning('room %d 未知包类型：operation=%d %s%s', self.room_id,
-                               header.operation, header, body)
-
-            offset += header.pack_len
+                logger.warning('room %d 未知包类型：operation=%d %s', self.room_id,
+                               operation, bytes(body))
 
     async def _handle_command(self, command):
-        if isinstance(command, list):
-            for one_command in command:
+        """
+        处理命令，command可以是一条命令或者命令列表
+
+        处理函数可以是普通函数，返回None时不会创建和等待协程
+        """
+        handlers = self._COMMAND_HANDLERS
+        counts = self._command_counts
+        for one_command in (command if isinstance(command, list) else (command,)):
+            if isinstance(one_command, list):
                 await self._handle_command(one_command)
-            return
+                continue
+            cmd = one_command.get('cmd', '')
+            counts[cmd] = counts.get(cmd, 0) + 1
+            try:
+                handler = handlers[cmd]
+            except KeyError:
+                handler = self._resolve_command_handler(cmd, one_command)
+            if handler is not None:
+                result = handler(self, one_command)
+                if result is not None:
+                    await result
 
-        cmd = command.get('cmd', '')
+    def _resolve_command_handler(self, cmd, command):
+        """
+        查找带参数的命令名的处理函数，结果缓存在_COMMAND_HANDLERS里，下次不用再解析
+        """
+        handlers = self._COMMAND_HANDLERS
+        name = cmd
         pos = cmd.find(':')  # 2019-5-29 B站弹幕升级新增了参数
         if pos != -1:
-            cmd = cmd[:pos]
-        if cmd in self._COMMAND_HANDLERS:
-            handler = self._COMMAND_HANDLERS[cmd]
-            if handler is not None:
-                await handler(self, command)
+            name = cmd[:pos]
+        if name in handlers:
+            handler = handlers[name]
         else:
-            logger.warning('room %d 未知命令：cmd=%s %s', self.room_id, cmd, command)
+            logger.warning('room %d 未知命令：cmd=%s %s', self.room_id, name, command)
             # 只有第一次遇到未知命令时log
-            self._COMMAND_HANDLERS[cmd] = None
+            handler = handlers[name] = None
+        handlers[cmd] = handler
+        return handler
+
+    def _on_disconnect(self, retry_count: int):
+        """
+        连接断开，1秒后重连
+        """
+        pass
 
     async def _on_receive_popularity(self, popularity: int):
         """
@@ -1,7 +1,15 @@
 $remotePath = "~/dev/bililive-danmuku-record/";
 $composeFilePath = "~/dev/"
 $fileList = "main.py", # main
-            "blivedm.py"
+            "archive.py",
+            "blivedm.py",
+            "events.py",
+            "jsoncodec.py",
+            "metrics.py",
+            "mongo.py",
+            "mongo_sink.py",
+            "pipeline.py",
+            "writer.py",
             "requirements.txt", # pip
             "dockerfile", # docker
             "docker-compose.yml";
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Type tagged event log of the paid events: gifts, guard buys and super chats
+
+Every line is a compact json array whose first item is the type tag, the
+other items follow the LAYOUTS of that type:
+
+    ["h", {"live_start_time": ..., "room_id": ...}]   header, resets the strings
+    ["s", 3, "辣条"]                                   defines string 3
+    ["g", 1605680870, 42, 0, 1, 3, 1, 100, 4, 100]     gift, uname face gift_name
+                                                       and coin_type are string ids
+
+Repeated strings (user names, face urls, gift names) are written once per
+session and referenced by id afterwards.
+"""
+import logging
+import os
+import time
+from typing import Iterator
+
+import blivedm
+import jsoncodec
+from writer import GroupCommitWriter
+
+logger = logging.getLogger(__name__)
+
+EVENT_EXT = ".evt"
+
+HEADER = "h"
+STRING = "s"
+GIFT = "g"
+GUARD = "b"
+SUPER_CHAT = "c"
+SUPER_CHAT_DELETE = "d"
+
+NAMES = {
+    GIFT: "gift",
+    GUARD: "guard",
+    SUPER_CHAT: "super_chat",
+    SUPER_CHAT_DELETE: "super_chat_delete",
+}
+LAYOUTS = {
+    GIFT: ("timestamp", "uid", "uname", "face", "gift_id", "gift_name", "num",
+           "price", "coin_type", "total_coin"),
+    GUARD: ("timestamp", "uid", "uname", "guard_level", "num", "price", "gift_id",
+            "gift_name", "end_time"),
+    SUPER_CHAT: ("timestamp", "id", "uid", "uname", "face", "guard_level", "price",
+                 "message", "end_time"),
+    SUPER_CHAT_DELETE: ("timestamp", "ids"),
+}
+INTERNED = {"uname", "face", "gift_name", "coin_type"}
+# positions of the interned fields in a record, the tag is position 0
+_INTERNED_POSITIONS = {
+    tag: tuple(index + 1 for index, field in enumerate(layout) if field in INTERNED)
+    for tag, layout in LAYOUTS.items()
+}
+
+def gift_event(gift: blivedm.GiftMessage) -> list:
+    return [GIFT, gift.timestamp, gift.uid, gift.uname, gift.face, gift.gift_id,
+            gift.gift_name, gift.num, gift.price, gift.coin_type, gift.total_coin]
+
+
+def guard_event(message: blivedm.GuardBuyMessage) -> list:
+    return [GUARD, message.start_time, message.uid, message.username, message.guard_level,
+            message.num, message.price, message.gift_id, message.gift_name, message.end_time]
+
+
+def super_chat_event(message: blivedm.SuperChatMessage) -> list:
+    return [SUPER_CHAT, message.start_time, message.id, message.uid, message.uname,
+            message.face, message.guard_level, message.price, message.message,
+            message.end_time]
+
+
+def super_chat_delete_event(message: blivedm.SuperChatDeleteMessage) -> list:
+    return [SUPER_CHAT_DELETE, int(time.time()), message.ids]
+
+
+class EventLog(GroupCommitWriter):
+    """
+    @description: GroupCommitWriter of type tagged events, strings of the
+    INTERNED fields are replaced by ids defined on first use
+    """
+
+    file_encoding = "utf-8"
+
+    def __init__(self, path, **kw):
+        if os.path.exists(path):
+            # the header of the new session must not be glued to a line cut by a crash
+            truncate_partial_line(path)
+        super().__init__(path, **kw)
+        self._strings = {}
+
+    def write_header(self, info: dict):
+        """
+        @description: Start a session, written on every open because the
+        string ids of the previous session are gone
+        """
+        self._strings.clear()
+        self.write(jsoncodec.dumps([HEADER, info], compact=True) + "\n")
+
+    def _intern(self, value) -> int:
+        string_id = self._strings.get(value)
+        if string_id is None:
+            string_id = self._strings[value] = len(self._strings)
+            self.write(jsoncodec.dumps([STRING, string_id, value], compact=True) + "\n")
+        return string_id
+
+    def write_record(self, event: list):
+        positions = _INTERNED_POSITIONS[event[0]]
+        if positions:
+            event = list(event)
+            for position in positions:
+                event[position] = self._intern(event[position])
+        self.write(jsoncodec.dumps(event, compact=True) + "\n")
+
+
+def truncate_partial_line(path, chunk_size=64 * 1024) -> int:
+    """
+    @description: Cut a log after its last complete line, returns the removed bytes
+    """
+    with open(path, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        end = size
+        while end > 0:
+            start = max(end - chunk_size, 0)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b"\n")
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        if end < size:
+            logger.warning(
+                "Truncate {} from {} to {} bytes, drop a partial line".format(path, size, end)
+            )
+            f.truncate(end)
+    return size - end
+
+
+def read_events(path) -> Iterator[dict]:
+    """
+    @description: Events of a log as dicts, with a "type" key and the header
+    of their session under "session"
+    """
+    strings = {}
+    session = None
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                item = jsoncodec.loads(line)
+            except ValueError:
+                logger.warning("Skip a broken line of {}: {!r}".format(path, line[:80]))
+                continue
+            tag = item[0]
+            if tag == HEADER:
+                session = item[1]
+                strings = {}
+            elif tag == STRING:
+                strings[item[1]] = item[2]
+            else:
+                event = dict(zip(LAYOUTS[tag], item[1:]))
+                for field in INTERNED.intersection(event):
+                    event[field] = strings[event[field]]
+                event["type"] = NAMES[tag]
+                event["session"] = session
+                yield event
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the bilibili room-init, getDanmuInfo and /sub websocket
+endpoints, plus a load client to point many BLiveClient at it
+
+    python fake_server.py serve --port 8000 --script 30:100,5:5000,30:100 --disconnect-every 20
+    python fake_server.py load --url http://127.0.0.1:8000 --clients 50 --duration 60
+"""
+import argparse
+import asyncio
+import functools
+import itertools
+import json
+import logging
+import struct
+import time
+from typing import List, Tuple
+
+import aiohttp
+from aiohttp import web
+
+import blivedm
+from blivedm import Operation
+from synthetic import COMPRESSORS, make_commands, make_packet, percentile
+
+logger = logging.getLogger(__name__)
+
+ROOM_INIT_PATH = "/xlive/web-room/v1/index/getInfoByRoom"
+DANMAKU_SERVER_CONF_PATH = "/xlive/web-room/v1/index/getDanmuInfo"
+WEBSOCKET_PATH = "/sub"
+
+SERVER_COMPRESSORS = dict(COMPRESSORS)
+if blivedm.brotli is not None:
+    # the default quality 11 is far too slow to compress live frames for many clients
+    SERVER_COMPRESSORS[blivedm.WS_BODY_PROTOCOL_VERSION_BROTLI] = functools.partial(
+        blivedm.brotli.compress, quality=5
+    )
+
+
+def parse_script(value: str) -> List[Tuple[float, float]]:
+    """
+    @description: Parse "<seconds>:<messages per second>,..." into phases, the
+    script loops when it reaches the end
+    """
+    phases = []
+    for phase in value.split(","):
+        duration, _, rate = phase.partition(":")
+        phases.append((float(duration), float(rate)))
+    return phases
+
+
+class FakeBroadcastServer:
+    """
+    @description: Speak the HEADER_STRUCT protocol to every connected client and
+    push synthetic commands following a rate script
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=8000,
+        script=((60.0, 100.0),),
+        ver=None,
+        tick=0.05,
+        disconnect_every=None,
+        popularity=10000,
+        live_status=1,
+    ):
+        """
+        :param script: [(seconds, messages per second), ...], loops forever
+        :param ver: protocol version of pushed frames, None follows the auth protover
+        :param tick: interval between two pushed frames (second)
+        :param disconnect_every: abort every connection after this many seconds
+        :param live_status: live_status returned by the room-init endpoint
+        """
+        self.host = host
+        self.port = port
+        self.script = list(script)
+        self.ver = ver
+        self.tick = tick
+        self.disconnect_every = disconnect_every
+        self.popularity = popularity
+        self.live_status = live_status
+        self.live_start_time = int(time.time())
+        # commands are encoded once, every frame only joins and compresses them
+        self.packets = [
+            make_packet(json.dumps(command).encode("utf-8"), Operation.SEND_MSG_REPLY)
+            for command in make_commands(5000)
+        ]
+        self.sent_commands = 0
+        self.connections = 0
+        self._runner = None
+
+        self.app = web.Application()
+        self.app.router.add_get(ROOM_INIT_PATH, self.room_init)
+        self.app.router.add_get(DANMAKU_SERVER_CONF_PATH, self.danmaku_server_conf)
+        self.app.router.add_get(WEBSOCKET_PATH, self.websocket)
+
+    @property
+    def base_url(self):
+        return "http://{}:{}".format(self.host, self.port)
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info("Fake broadcast server listening on {}".format(self.base_url))
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def room_init(self, request: web.Request):
+        room_id = int(request.query.get("room_id", 0))
+        return web.json_response(
+            {
+                "code": 0,
+                "msg": "ok",
+                "data": {
+                    "room_info": {
+                        "room_id": room_id,
+                        "short_id": 0,
+                        "uid": room_id,
+                        "live_status": self.live_status,
+                        "live_start_time": self.live_start_time,
+                    }
+                },
+            }
+        )
+
+    async def danmaku_server_conf(self, request: web.Request):
+        host = {
+            "host": self.host,
+            "port": self.port,
+            "wss_port": self.port,
+            "ws_port": self.port,
+        }
+        return web.json_response(
+            {"code": 0, "msg": "ok", "data": {"token": "fake", "host_list": [host]}}
+        )
+
+    async def websocket(self, request: web.Request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.connections += 1
+        ver = self.ver
+        pusher = None
+        try:
+            async for message in ws:
+                if message.type != aiohttp.WSMsgType.BINARY:
+                    continue
+                for operation, body in blivedm.iter_packets(message.data):
+                    if operation == Operation.AUTH:
+                        if ver is None:
+                            protover = json.loads(str(body, "utf-8")).get("protover")
+                            ver = protover if protover in COMPRESSORS else min(COMPRESSORS)
+                        await ws.send_bytes(make_packet(b'{"code":0}', Operation.AUTH_REPLY))
+                        pusher = asyncio.ensure_future(self._push(ws, request, ver))
+                    elif operation == Operation.HEARTBEAT:
+                        await ws.send_bytes(
+                            make_packet(
+                                struct.pack(">I", self.popularity),
+                                Operation.HEARTBEAT_REPLY,
+                                blivedm.WS_BODY_PROTOCOL_VERSION_INT,
+                            )
+                        )
+        finally:
+            if pusher is not None:
+                pusher.cancel()
+        return ws
+
+    async def _push(self, ws: web.WebSocketResponse, request: web.Request, ver):
+        packets = itertools.cycle(self.packets)
+        connected_at = last = time.monotonic()
+        owed = 0.0
+        try:
+            for duration, rate in itertools.cycle(self.script):
+                phase_end = time.monotonic() + duration
+                while time.monotonic() < phase_end:
+                    now = time.monotonic()
+                    if (
+                        self.disconnect_every is not None
+                        and now - connected_at >= self.disconnect_every
+                    ):
+                        # abrupt disconnect, no close frame
+                        if request.transport is not None:
+                            request.transport.abort()
+                        return
+                    owed += rate * (now - last)
+                    last = now
+                    count, owed = int(owed), owed - int(owed)
+                    if count:
+                        body = b"".join(itertools.islice(packets, count))
+                        await ws.send_bytes(
+                            make_packet(SERVER_COMPRESSORS[ver](body), Operation.SEND_MSG_REPLY, ver)
+                        )
+                        self.sent_commands += count
+                    await asyncio.sleep(self.tick)
+        except (ConnectionResetError, RuntimeError):
+            # client went away while sending
+            pass
+
+
+class LoadClient(blivedm.BLiveClient):
+    """
+    @description: Client that counts commands and measures reconnection gaps,
+    consumer_delay blocks the event loop per danmaku like a slow disk does
+    """
+
+    _COMMAND_HANDLERS = blivedm.BLiveClient._COMMAND_HANDLERS.copy()
+    _websocket_url = "ws://{host}:{ws_port}" + WEBSOCKET_PATH
+
+    def __init__(self, room_id, base_url, consumer_delay=0.0, **kw):
+        super().__init__(room_id, **kw)
+        self._room_init_url = base_url + ROOM_INIT_PATH
+        self._danmaku_server_conf_url = base_url + DANMAKU_SERVER_CONF_PATH
+        self.consumer_delay = consumer_delay
+        self.danmaku_count = 0
+        self.disconnected_at = None
+        self.reconnect_gaps: List[float] = []
+
+    async def _handle_message(self, data):
+        if self.disconnected_at is not None:
+            self.reconnect_gaps.append(time.monotonic() - self.disconnected_at)
+            self.disconnected_at = None
+        await super()._handle_message(data)
+
+    def _on_disconnect(self, retry_count):
+        if self.disconnected_at is None:
+            self.disconnected_at = time.monotonic()
+
+    def _on_receive_danmaku(self, danmaku):
+        self.danmaku_count += 1
+        if self.consumer_delay:
+            time.sleep(self.consumer_delay)
+
+
+async def run_load(base_url, clients=10, duration=30.0, consumer_delay=0.0) -> dict:
+    async with aiohttp.ClientSession() as session:
+        load_clients = [
+            LoadClient(
+                100000 + index,
+                base_url,
+                consumer_delay=consumer_delay,
+                session=session,
+                ssl=False,
+            )
+            for index in range(clients)
+        ]
+        futures = [client.start() for client in load_clients]
+        await asyncio.sleep(duration)
+        running = [client.stop() for client in load_clients if client.is_running]
+        if running:
+            await asyncio.wait(running)
+
+    # clients whose message loop ended on its own, e.g. the server is not there
+    errors = [
+        repr(future.exception())
+        for future in futures
+        if not future.cancelled() and future.exception() is not None
+    ]
+    if errors:
+        logger.warning(
+            "{} of {} load clients failed, first error: {}".format(
+                len(errors), clients, errors[0]
+            )
+        )
+    gaps = sorted(gap for client in load_clients for gap in client.reconnect_gaps)
+    danmaku = sum(client.danmaku_count for client in load_clients)
+    return {
+        "clients": clients,
+        "duration": duration,
+        "danmaku": danmaku,
+        "danmaku_per_sec": danmaku / duration,
+        "reconnects": sum(client.reconnect_count for client in load_clients),
+        "reconnect_gap_p50": percentile(gaps, 0.5) if gaps else None,
+        "reconnect_gap_max": gaps[-1] if gaps else None,
+        "failed_clients": len(errors),
+        "errors": sorted(set(errors)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    serve = sub.add_parser("serve", help="run the fake broadcast server")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8000)
+    serve.add_argument(
+        "--script", type=parse_script, default="60:100",
+        help="<seconds>:<messages per second>,... looped",
+    )
+    serve.add_argument("--ver", type=int, choices=sorted(COMPRESSORS),
+                       help="protocol version, default follows the client")
+    serve.add_argument("--tick", type=float, default=0.05)
+    serve.add_argument("--disconnect-every", type=float)
+    serve.add_argument("--live-status", type=int, default=1)
+
+    load = sub.add_parser("load", help="connect many clients to a fake server")
+    load.add_argument("--url", default="http://127.0.0.1:8000")
+    load.add_argument("--clients", type=int, default=10)
+    load.add_argument("--duration", type=float, default=30)
+    load.add_argument("--consumer-delay", type=float, default=0.0,
+                      help="blocking seconds spent per danmaku")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    if args.command == "serve":
+        server = FakeBroadcastServer(
+            args.host, args.port, args.script, args.ver, args.tick,
+            args.disconnect_every, live_status=args.live_status,
+        )
+        loop.run_until_complete(server.start())
+        try:
+            loop.run_forever()
+        finally:
+            loop.run_until_complete(server.stop())
+    else:
+        result = loop.run_until_complete(
+            run_load(args.url, args.clients, args.duration, args.consumer_delay)
+        )
+        print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+JSON codec shared by the websocket client, the recorder and the xml generator
+
+Decoding uses the fastest installed backend (orjson, then the stdlib json).
+Encoding always goes through the stdlib encoder, so danmaku files and packets
+stay byte-identical whatever backend is installed: orjson can only emit
+compact utf-8 output, while the existing files are `json.dumps` formatted.
+Set JSON_BACKEND=json to force the stdlib decoder.
+"""
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_encoder = json.JSONEncoder()
+_compact_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+
+def _json_loads(data):
+    if isinstance(data, (memoryview, bytearray)):
+        data = str(data, "utf-8")
+    return json.loads(data)
+
+
+def _orjson_loads(data):
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        # orjson rejects what json accepts, e.g. integers wider than 64 bits
+        return _json_loads(data)
+
+
+BACKENDS = {"json": _json_loads}
+if orjson is not None:
+    BACKENDS["orjson"] = _orjson_loads
+
+backend = None
+loads = None
+
+
+def use_backend(name):
+    """
+    @description: Switch the decoder, name is one of BACKENDS
+    """
+    global backend, loads
+    if name not in BACKENDS:
+        raise ValueError(
+            "JSON backend {} is not available, choose from {}".format(
+                name, list(BACKENDS)
+            )
+        )
+    backend = name
+    loads = BACKENDS[name]
+
+
+def dumps(obj, compact=False) -> str:
+    """
+    @description: Same output as json.dumps(obj) with default arguments, or
+    without spaces and ascii escapes when compact, for the newer formats
+    """
+    return (_compact_encoder if compact else _encoder).encode(obj)
+
+
+use_backend(os.getenv("JSON_BACKEND", "orjson" if orjson is not None else "json"))
@@ -1,26 +1,32 @@
 from logging import info
+import asyncio
 import time
 from typing import Union
 from pymongo.collection import Collection
 from requests.models import get_cookie_header
 from mongo import MongoDB, get_data_col, get_info_col, db_connect, db
 from bili_api import (
+    ChunkCache,
     Danmaku,
     LiveRecordInfo,
     get_live_info,
-    get_danmaku,
+    crawl_danmaku,
     get_live_record_list,
 )
 from bson.objectid import ObjectId
 
 
+INSERT_BATCH_SIZE = 1000
+
+
 class MongoDanmaku(Danmaku):
-    def __init__(self, id, **kwargs) -> None:
+    def __init__(self, id, chunk=None, **kwargs) -> None:
         # print(kwargs.text)
         super().__init__(**kwargs)
         if not isinstance(id, ObjectId):
             id = ObjectId(id)
         self.creator = id
+        self.chunk = chunk  # index of the replay chunk, used to resume a record
 
 
 def main_loop():
@@ -28,27 +34,71 @@ def main_loop():
     record_list = get_live_record_list(92613)
     info_col = get_info_col(db.mongo_client)
     print("Record list count: {}".format(len(record_list)))
+    # one query for every record, info without "complete" predates resuming
+    known = {
+        doc["rid"]: doc
+        for doc in info_col.find(
+            {"rid": {"$in": [record.rid for record in record_list]}},
+            {"rid": 1, "complete": 1, "chunks_done": 1},
+        )
+    }
     for record in record_list:
-        if not info_col.count_documents({"rid": record.rid}):
+        info_doc = known.get(record.rid)
+        if info_doc is not None and info_doc.get("complete", True):
+            continue
+        if info_doc is None:
             print("Start to crawling record {}".format(record.rid))
-            try:
-                save_record(record.rid)
-            except Exception as e:
-                print("Fail in crawling record, rid is {}".format(record.rid))
+        else:
+            print("Resume crawling record {}".format(record.rid))
+        try:
+            save_record(record.rid, info_doc)
+        except Exception as e:
+            print("Fail in crawling record, rid is {}".format(record.rid))
+
 
+def insert_chunk(data_col: Collection, insert_list: list):
+    for start in range(0, len(insert_list), INSERT_BATCH_SIZE):
+        data_col.insert_many(insert_list[start : start + INSERT_BATCH_SIZE], ordered=False)
 
-def save_record(rid):
+
+def save_record(rid, info_doc=None):
+    """
+    info_doc is the info of an interrupted crawl, its finished chunks are skipped
+    """
     info: LiveRecordInfo = get_live_info(rid)
     info_col: Collection = get_info_col(db.mongo_client)
-    result = info_col.insert_one(dict(info.live_info))
-    for dm_info in info.dm_info.index_info:
-        dm_list = get_danmaku(rid, dm_info.index)
-        insert_list = []
-        for item in dm_list:
-            insert_data = MongoDanmaku(result.inserted_id, **dict(item))
-            insert_list.append(dict(insert_data))
-        data_col: Collection = get_data_col(db.mongo_client)
-        data_col.insert_many(insert_list)
+    data_col: Collection = get_data_col(db.mongo_client)
+    if info_doc is None:
+        result = info_col.insert_one(
+            dict(dict(info.live_info), complete=False, chunks_done=[])
+        )
+        creator = result.inserted_id
+        chunks_done = set()
+    else:
+        creator = info_doc["_id"]
+        chunks_done = set(info_doc.get("chunks_done", []))
+        # drop what the interrupted chunk left behind, it is crawled again
+        data_col.delete_many({"creator": creator, "chunk": {"$nin": list(chunks_done)}})
+    pending = [dm for dm in info.dm_info.index_info if dm.index not in chunks_done]
+
+    async def crawl():
+        loop = asyncio.get_event_loop()
+        # chunks arrive in index order while the next ones are being fetched
+        async for dm_info, dm_list in crawl_danmaku(rid, pending, cache=ChunkCache()):
+            insert_list = []
+            for item in dm_list:
+                insert_data = MongoDanmaku(creator, chunk=dm_info.index, **dict(item))
+                insert_list.append(dict(insert_data))
+            await loop.run_in_executor(None, insert_chunk, data_col, insert_list)
+            await loop.run_in_executor(
+                None,
+                info_col.update_one,
+                {"_id": creator},
+                {"$addToSet": {"chunks_done": dm_info.index}},
+            )
+
+    asyncio.get_event_loop().run_until_complete(crawl())
+    info_col.update_one({"_id": creator}, {"$set": {"complete": True}})
 
 
 if __name__ == "__main__":
@@ -1,31 +1,109 @@
 # -*- coding: utf-8 -*-
 import asyncio
-import json
+import collections
+import enum
+import functools
 import logging
 import os
+import random
 import shutil
 import sys
 
 import time
 import traceback
 from logging.handlers import TimedRotatingFileHandler
-from typing import Union
+from typing import Dict, List, Union
 
+import aiohttp
 import requests as rq
 import sentry_sdk
 from sentry_sdk.integrations.logging import LoggingIntegration
 
+import archive
 import blivedm
+import events
+import jsoncodec
+import metrics
+import mongo
+import mongo_sink
+import pipeline
+import writer
+from pipeline import OverflowPolicy, RecordQueue
+from writer import DurabilityPolicy, GroupCommitWriter, parse_durability
 
 room_id_defalut = 92613
 log_level_default = logging.INFO
 log_path_default = "./log"
 tmp_dir = "./"
+archive_dir = "./danmaku/"
 proxy_url = None
+room_poll_interval = 10
+room_poll_jitter = 0.2  # fraction of the interval
+room_status_timeout = 5
+live_restart_cooldown = 20  # Maybe would not return None after live end
+QUEUE_SPILL_PREFIX = "spill-queue-"
+ARCHIVE_FORMATS = ("jsonl", "block")  # see archive.py for block
+archive_format = "jsonl"
+writer_config = {
+    "max_count": 512,
+    "max_delay": 1.0,
+    "policy": DurabilityPolicy.FLUSH,
+    "fsync_interval": 1000,
+}
+queue_config = {
+    "maxsize": 10000,
+    "overflow": OverflowPolicy.BLOCK,
+}
+event_priority = 1  # danmaku are 0
+poll_connection_limit = 10  # concurrent room status requests of all rooms
+metrics_port = None  # serve /metrics when set, see metrics.py
+mongo_sink_enabled = False  # also insert live danmaku into mongo, see mongo_sink.py
+mongo_sink_config = {
+    "max_count": 500,
+    "max_delay": 1.0,
+    "max_pending": 20000,
+}
 
 logger = logging.getLogger(__name__)
 sentry_logger = logging.getLogger("sentry")
 
+command_counter = metrics.Counter(
+    "danmaku_commands_total", "Commands received", ("room", "cmd")
+)
+frame_latency = metrics.Histogram(
+    "danmaku_frame_seconds", "Decode and dispatch time of a websocket frame", ("room",)
+)
+received_bytes = metrics.Counter(
+    "danmaku_received_bytes_total", "Websocket frame bytes, compressed", ("room",)
+)
+decoded_bytes = metrics.Counter(
+    "danmaku_decoded_bytes_total", "Packet body bytes, decompressed", ("room",)
+)
+reconnect_counter = metrics.Counter(
+    "danmaku_reconnects_total", "Websocket reconnects of all lives", ("room",)
+)
+commit_latency = metrics.Histogram(
+    "danmaku_writer_commit_seconds",
+    "Encode, write and flush time of a writer commit",
+    ("room", "writer"),
+)
+popularity_gauge = metrics.Gauge("danmaku_popularity", "Current popularity", ("room",))
+live_gauge = metrics.Gauge("danmaku_room_live", "1 while the room is recorded", ("room",))
+queue_depth_gauge = metrics.Gauge(
+    "danmaku_queue_depth", "Records waiting for the writer thread", ("room",)
+)
+queue_dropped_counter = metrics.Counter(
+    "danmaku_queue_dropped_total", "Records dropped by a full queue", ("room",)
+)
+queue_spilled_counter = metrics.Counter(
+    "danmaku_queue_spilled_total", "Records spilled by a full queue", ("room",)
+)
+queue_spill_dropped_counter = metrics.Counter(
+    "danmaku_queue_spill_dropped_total",
+    "Records dropped by a spilling queue whose spill file falls behind",
+    ("room",),
+)
+
 
 def strip_sensitive_data(event, hint):
     if event["logger"] == "sentry":
@@ -63,12 +141,22 @@ def log_config(log_level, log_path, dsn=None):
     fhlr.setFormatter(formatter)
     logger.addHandler(fhlr)
     blivedm.logger.addHandler(fhlr)
+    writer.logger.addHandler(fhlr)
+    archive.logger.addHandler(fhlr)
+    mongo_sink.logger.addHandler(fhlr)
+    pipeline.logger.addHandler(fhlr)
+    metrics.logger.addHandler(fhlr)
 
     # output to stdout
     chlr = logging.StreamHandler(sys.stdout)
     chlr.setFormatter(formatter)
     logger.addHandler(chlr)
     blivedm.logger.addHandler(chlr)
+    writer.logger.addHandler(chlr)
+    archive.logger.addHandler(chlr)
+    mongo_sink.logger.addHandler(chlr)
+    pipeline.logger.addHandler(chlr)
+    metrics.logger.addHandler(chlr)
 
     # sentry event
     if dsn:
@@ -87,25 +175,143 @@ def log_config(log_level, log_path, dsn=None):
         logger.warning("Not provide dsn url, will not use it.")
 
 
-class MyBLiveClient(blivedm.BLiveClient):
-    def __init__(self, room, live_start_time, **kw):
-        super().__init__(room, ssl=True)
+def open_writers(tmp_dir, live_start_time, room, loop=None):
+    """
+    @description: Danmaku writer and event log of a live. They belong to the
+    queue thread, which commits through tick
+    """
+    if archive_format == "block":
+        tmp_filename = "{}tmp-{}{}".format(tmp_dir, live_start_time, archive.ARCHIVE_EXT)
+        writer_cls = archive.ArchiveWriter
+    else:
         tmp_filename = "{}tmp-{}.txt".format(tmp_dir, live_start_time)
-        self.d_file = open(tmp_filename, "a")
+        writer_cls = GroupCommitWriter
+    writer = writer_cls(tmp_filename, loop=loop, timers=False, **writer_config)
+
+    # write the info line (first line), if file is blank
+    live_info = {"live_start_time": live_start_time, "room_id": room}
+    if writer.tell():
+        logger.info(
+            "Danmaku file {} already exist, continue recording".format(tmp_filename)
+        )
+    else:
+        writer.write_header(live_info)
+    event_log = events.EventLog(
+        "{}tmp-{}{}".format(tmp_dir, live_start_time, events.EVENT_EXT),
+        loop=loop,
+        timers=False,
+        **writer_config
+    )
+    event_log.write_header(live_info)
+    return writer, event_log
+
+
+def write_records(writer, event_log, records):
+    """
+    @description: Runs in the queue thread, the only user of the writers.
+    Danmaku are dicts, paid events are type tagged lists
+    """
+    for record in records:
+        if type(record) is dict:
+            writer.write_record(record)
+        else:
+            event_log.write_record(record)
+    writer.tick()
+    event_log.tick()
+
+
+def queue_spill_path(tmp_dir, live_start_time):
+    return "{}{}{}.txt".format(tmp_dir, QUEUE_SPILL_PREFIX, live_start_time)
+
+
+def recover_spill_files(tmp_dir, room):
+    """
+    @description: Write the records a crashed run left in queue spill files
+    into the tmp files of their live, so they are archived with it
+    """
+    for file_name in os.listdir(tmp_dir):
+        stem, ext = os.path.splitext(file_name)
+        if not stem.startswith(QUEUE_SPILL_PREFIX) or ext != ".txt":
+            continue
+        live_start_time = int(stem[len(QUEUE_SPILL_PREFIX):])
+        writer, event_log = open_writers(tmp_dir, live_start_time, room)
+        # a queue reads a leftover spill file back before anything else
+        queue = RecordQueue(
+            functools.partial(write_records, writer, event_log),
+            spill_path=tmp_dir + file_name,
+            name="room {} recovery".format(room),
+        )
+        queue.start()
+        queue.close()
+        writer.close()
+        event_log.close()
+
 
-        # write the info line (first line), if file is blank
-        if not self.d_file.tell():
-            logger.info(
-                "Danmaku file {} already exist, continue recording".format(tmp_filename)
+class MyBLiveClient(blivedm.BLiveClient):
+    def __init__(self, room, live_start_time, tmp_dir=tmp_dir, **kw):
+        kw.setdefault("ssl", True)
+        super().__init__(room, **kw)
+        self.writer, self.events = open_writers(
+            tmp_dir, live_start_time, room, loop=self._loop
+        )
+        self.live_start_time = live_start_time
+        self.sink = None
+        if mongo_sink_enabled:
+            self.sink = mongo_sink.MongoSink(
+                mongo.get_live_col(mongo.db.mongo_client),
+                "{}spill-{}.txt".format(tmp_dir, live_start_time),
+                loop=self._loop,
+                **mongo_sink_config
             )
-            live_info = {"live_start_time": live_start_time, "room_id": room_id}
-            self.d_file.writelines(json.dumps(live_info) + "\n")
-            self.d_file.flush()
+
+        self._metric_room = str(room)
+        self.writer.on_commit = functools.partial(
+            commit_latency.observe, (self._metric_room, "danmaku")
+        )
+        self.events.on_commit = functools.partial(
+            commit_latency.observe, (self._metric_room, "events")
+        )
+        self.queue = RecordQueue(
+            self._write_records,
+            spill_path=queue_spill_path(tmp_dir, live_start_time),
+            loop=self._loop,
+            name="room {}".format(room),
+            **queue_config
+        )
+        self.queue.start()
 
     _COMMAND_HANDLERS = blivedm.BLiveClient._COMMAND_HANDLERS.copy()
 
-    async def _on_receive_danmaku(self, danmaku: blivedm.DanmakuMessage):
-        logger.debug(f"{danmaku.uname}：{danmaku.msg} time:{danmaku.timestamp}")
+    async def _handle_message(self, data):
+        if self.queue.full:
+            # with BLOCK overflow, leave the frames in the socket until the disk catches up
+            await self.queue.wait_for_room()
+        time_s = time.perf_counter()
+        await super()._handle_message(data)
+        frame_latency.observe((self._metric_room,), time.perf_counter() - time_s)
+
+    async def _on_receive_popularity(self, popularity: int):
+        popularity_gauge.set((self._metric_room,), popularity)
+
+    def _write_records(self, records):
+        write_records(self.writer, self.events, records)
+
+    # paid events are queued with a higher priority, DROP overflow drops danmaku first
+    def _on_receive_gift(self, gift: blivedm.GiftMessage):
+        self.queue.put(events.gift_event(gift), event_priority)
+
+    def _on_buy_guard(self, message: blivedm.GuardBuyMessage):
+        self.queue.put(events.guard_event(message), event_priority)
+
+    def _on_super_chat(self, message: blivedm.SuperChatMessage):
+        self.queue.put(events.super_chat_event(message), event_priority)
+
+    def _on_super_chat_delete(self, message: blivedm.SuperChatDeleteMessage):
+        self.queue.put(events.super_chat_delete_event(message), event_priority)
+
+    # no await inside, so the dispatcher calls it without creating a coroutine
+    def _on_receive_danmaku(self, danmaku: blivedm.DanmakuMessage):
+        logger.debug("%s：%s time:%s", danmaku.uname, danmaku.msg, danmaku.timestamp)
         data = {
             "uid": danmaku.uid,
             "uname": danmaku.uname,
@@ -118,43 +324,129 @@ class MyBLiveClient(blivedm.BLiveClient):
             "bubble": danmaku.bubble,
         }
         try:
-            self.d_file.writelines(json.dumps(data) + "\n")
-            self.d_file.flush()
+            self.queue.put(data)
             # uid 用户名 字体大小 颜色 内容 时间戳 是否为礼物（0:用户弹幕;1:礼物弹幕;2:主播礼物弹幕，抽奖）弹幕类型 超话？
+            if self.sink is not None:
+                self.sink.write(
+                    dict(data, room_id=self.room_id, live_start_time=self.live_start_time)
+                )
         except IOError as e:
             logger.error("{}, detail:\n{}".format(e, traceback.format_exc(limit=2)))
             sentry_logger.exception("Network error", extra=e)
 
 
-async def wait_live_end():
+def transfer_tmp_file(src_dir=tmp_dir, dst_dir=archive_dir):
+    archived = []
+    for file_name in os.listdir(src_dir):
+        if os.path.isfile(src_dir + file_name):
+            stem, ext = os.path.splitext(file_name)
+            prefix = stem.split("-")[0]
+            if prefix == "tmp":
+                name = stem.split("-")[-1]
+                logger.info(
+                    "Copying tmp file {} to row danmaku folder".format(file_name)
+                )
+                # line-delimited json is archived as .json, other formats keep their ext
+                ext = ".json" if ext == ".txt" else ext
+                shutil.copy(src_dir + file_name, dst_dir + name + ext)
+                os.remove(src_dir + file_name)
+                archived.append(dst_dir + name + ext)
+    return archived
+
+
+def client_counters(client: MyBLiveClient) -> collections.Counter:
     """
-    @description: Wait until live end
+    @description: (metric, extra label values) -> value of the counters kept
+    by a client, they start from zero with every live
     """
+    stats = client.queue.stats()
+    counters = collections.Counter(
+        {
+            (received_bytes, ()): client.bytes_received,
+            (decoded_bytes, ()): client.bytes_decoded,
+            (reconnect_counter, ()): client.reconnect_count,
+            (queue_dropped_counter, ()): stats["dropped"],
+            (queue_spilled_counter, ()): stats["spilled"],
+            (queue_spill_dropped_counter, ()): stats["spill_dropped"],
+        }
+    )
+    # parsed here, at scrape time, instead of once per message
+    for cmd, count in client.command_counts.items():
+        counters[command_counter, (cmd.split(":", 1)[0],)] += count
+    return counters
 
-    while True:
-        time_s = time.time()
-        await asyncio.sleep(10)
+
+def index_archives(paths):
+    """
+    @description: Write the time index sidecar of every archived file
+    """
+    for path in paths:
         try:
-            resp = rq.get(
-                "https://api.live.bilibili.com/xlive/web-room/v1/index/getInfoByRoom?room_id={}".format(
-                    room_id
+            archive.build_index(path)
+        except Exception as e:
+            logger.error(
+                "Fail to index {}, detail: \n{}".format(
+                    path, traceback.format_exc(limit=2)
                 )
             )
-            status = resp.json()["data"]["room_info"]["live_status"]
-            logger.debug(
-                "room status is:{}, interval:{}".format(status, time.time() - time_s)
-            )
-            if status == 0:
-                transfer_tmp_file() # copy file there in case file overwrite
-                break
-        except TypeError as e:
+            sentry_logger.exception("Error when indexing archive", extra=e)
+
+
+class RoomState(enum.Enum):
+    IDLE = "idle"
+    LIVE = "live"
+    FINALIZING = "finalizing"
+
+
+async def get_room_status(
+    session: aiohttp.ClientSession, room_id, timeout=room_status_timeout
+):
+    """
+    @description: Fetch (live_status, live_start_time) of a room over a shared session
+    """
+    async with session.get(
+        blivedm.ROOM_INIT_URL,
+        params={"room_id": room_id},
+        timeout=aiohttp.ClientTimeout(total=timeout),
+    ) as resp:
+        data = await resp.json(content_type=None, loads=jsoncodec.loads)
+    room_info = data["data"]["room_info"]
+    return room_info["live_status"], room_info["live_start_time"]
+
+
+def jittered(interval, jitter=room_poll_jitter):
+    return interval * random.uniform(1 - jitter, 1 + jitter)
+
+
+async def poll_room_status(
+    session: aiohttp.ClientSession,
+    room_id,
+    interval=room_poll_interval,
+    timeout=room_status_timeout,
+):
+    """
+    @description: Yield (live_status, live_start_time) every jittered interval,
+    the request never blocks the event loop so websocket frames and heartbeats
+    keep flowing during a slow api response
+    """
+    while True:
+        time_s = time.time()
+        try:
+            status, live_start_time = await get_room_status(session, room_id, timeout)
+        except asyncio.CancelledError:
+            raise
+        except (
+            TypeError,
+            KeyError,
+            ValueError,
+            aiohttp.ClientError,
+            asyncio.TimeoutError,
+        ) as e:
             logger.debug(
-                "Fail to get the room ({}) status in wait_live_end, will try soon, detail {}".format(
+                "Fail to get the room ({}) status, will try soon, detail {}".format(
                     room_id, e
                 ),
             )
-            await asyncio.sleep(10)
-
         except Exception as e:
             logger.error(
                 "Unknown error {} occur, detail: \n{}".format(
@@ -162,42 +454,256 @@ async def wait_live_end():
                 )
             )
             sentry_logger.exception("Error when getting room info", extra=e)
-            await asyncio.sleep(10)
+        else:
+            logger.debug(
+                "room {} status is:{}, interval:{}".format(
+                    room_id, status, time.time() - time_s
+                )
+            )
+            yield status, live_start_time
+        await asyncio.sleep(jittered(interval))
 
 
-def transfer_tmp_file():
-    for file_name in os.listdir(tmp_dir):
-        if os.path.isfile(tmp_dir + file_name):
-            prefix = os.path.splitext(file_name)[0].split("-")[0]
-            if prefix == "tmp":
-                name = os.path.splitext(file_name)[0].split("-")[-1]
-                logger.info(
-                    "Copying tmp file {} to row danmaku folder".format(file_name)
+class RoomRecorder:
+    """
+    @description: Lifecycle of one watched room, idle -> live -> finalizing -> idle
+    """
+
+    def __init__(
+        self,
+        room_id,
+        session: aiohttp.ClientSession,
+        tmp_dir=tmp_dir,
+        archive_dir=archive_dir,
+        bark_token=None,
+    ):
+        self.room_id = room_id
+        self.session = session
+        self.tmp_dir = tmp_dir
+        self.archive_dir = archive_dir
+        self.bark_token = bark_token
+        self.state = RoomState.IDLE
+        self.client: Union[MyBLiveClient, None] = None
+        self.stopping_client: Union[MyBLiveClient, None] = None
+        self.live_end_time = 0
+        self.notified_live = None
+        # counters of the finished clients, so the exported totals never go back
+        self.finished_counters = collections.Counter()
+        for path in (tmp_dir, archive_dir):
+            os.makedirs(path, exist_ok=True)
+        recover_spill_files(tmp_dir, room_id)
+
+    async def update(self, status, live_start_time):
+        if self.state is RoomState.IDLE and status == 1:
+            if time.time() - self.live_end_time < live_restart_cooldown:
+                return
+            self.start(live_start_time)
+        elif self.state is RoomState.LIVE and status == 0:
+            await self.finalize()
+
+    def start(self, live_start_time):
+        logger.info(
+            "room {} live start on {}".format(
+                self.room_id, time.asctime(time.localtime(live_start_time))
+            )
+        )
+        if live_start_time != self.notified_live:
+            # once per live, not again when a failed client is restarted
+            self.notified_live = live_start_time
+            # bark uses blocking requests, keep it off the event loop
+            asyncio.get_event_loop().run_in_executor(
+                None, send_notif_bark, self.bark_token, self.room_id
+            )
+        self.client = MyBLiveClient(
+            self.room_id,
+            live_start_time,
+            tmp_dir=self.tmp_dir,
+            session=self.session,
+        )
+        self.client.start().add_done_callback(
+            functools.partial(self._on_client_done, self.client)
+        )
+        self.state = RoomState.LIVE
+
+    def _on_client_done(self, client: MyBLiveClient, future: asyncio.Future):
+        if future.cancelled() or client is not self.client:
+            return  # stopped by stop_client
+        logger.error(
+            "room {} message loop ended while live, detail: {!r}".format(
+                self.room_id, future.exception()
+            )
+        )
+        # keep the tmp files and record again on the next poll that is live
+        self.state = RoomState.FINALIZING
+        asyncio.ensure_future(self._reset_after_failure())
+
+    async def _reset_after_failure(self):
+        try:
+            await self.stop_client()
+        except Exception as e:
+            logger.error(
+                "Fail to stop the client of room {}, detail: \n{}".format(
+                    self.room_id, traceback.format_exc(limit=2)
                 )
-                shutil.copy(tmp_dir + file_name, "./danmaku/" + name + ".json")
-                os.remove(tmp_dir + file_name)
+            )
+            sentry_logger.exception("Error when stopping client", extra=e)
+        finally:
+            self.state = RoomState.IDLE
+
+    async def stop_client(self):
+        client, self.client = self.client, None
+        if client is None:
+            return
+        # still counted while it stops, a scrape in between must not see a dip
+        self.stopping_client = client
+        try:
+            if client.is_running:
+                await asyncio.wait([client.stop()])
+            await client.queue.aclose()
+            client.writer.close()
+            client.events.close()
+            if client.sink is not None:
+                await client.sink.close()
+            await client.close()
+        finally:
+            self.stopping_client = None
+            self.finished_counters.update(client_counters(client))
+            popularity_gauge.remove((str(self.room_id),))
+
+    def counters(self) -> collections.Counter:
+        """
+        @description: Running totals of the client counters over every live
+        """
+        counters = collections.Counter(self.finished_counters)
+        for client in (self.client, self.stopping_client):
+            if client is not None:
+                counters.update(client_counters(client))
+        return counters
+
+    async def finalize(self):
+        self.state = RoomState.FINALIZING
+        try:
+            await self.stop_client()
+            archived = transfer_tmp_file(self.tmp_dir, self.archive_dir)
+            # indexing reads the whole file, keep it off the event loop
+            await asyncio.get_event_loop().run_in_executor(
+                None,
+                index_archives,
+                [path for path in archived if not path.endswith(events.EVENT_EXT)],
+            )
+        finally:
+            self.live_end_time = time.time()
+            self.state = RoomState.IDLE
+        logger.info("room {} live end on {}".format(self.room_id, time.asctime()))
 
+    async def close(self):
+        """
+        @description: Stop recording without finalizing, tmp file is kept for continue
+        """
+        await self.stop_client()
+        self.state = RoomState.IDLE
 
-async def main_loop(live_start_time):
-    logger.info(
-        "live start on {}".format(time.asctime(time.localtime(live_start_time)))
-    )
-    client = MyBLiveClient(room_id, ssl=True, live_start_time=live_start_time)
-    # 如果SSL验证失败就把ssl设为False
-    client.start()
-    try:
-        await wait_live_end()
-    finally:
-        client.d_file.close()
-        await client.close()
-        # transfer_tmp_file()
-    logger.info("live end on {}".format(time.asctime()))
+
+class MultiRoomRecorder:
+    """
+    @description: Watch many rooms on one event loop. The danmaku websockets
+    share one unlimited pool, since every live room holds its connection for
+    the whole live. Status polls use their own small pool, so they still get
+    a connection however many rooms are live
+    """
+
+    def __init__(
+        self,
+        room_ids: List[int],
+        poll_interval=room_poll_interval,
+        bark_token=None,
+        poll_connection_limit=poll_connection_limit,
+        per_room_dirs=True,
+        metrics_port=metrics_port,
+    ):
+        self.room_ids = room_ids
+        self.metrics_port = metrics_port
+        self.per_room_dirs = per_room_dirs
+        self.poll_interval = poll_interval
+        self.bark_token = bark_token
+        self.poll_connection_limit = poll_connection_limit
+        self.session: Union[aiohttp.ClientSession, None] = None
+        self.poll_session: Union[aiohttp.ClientSession, None] = None
+        self.rooms: Dict[int, RoomRecorder] = {}
+
+    def collect_metrics(self):
+        """
+        @description: Copy the client counters into the metrics before a scrape
+        """
+        for room_id, recorder in self.rooms.items():
+            labels = (str(room_id),)
+            client = recorder.client
+            live_gauge.set(labels, int(client is not None))
+            queue_depth_gauge.set(labels, client.queue.depth if client is not None else 0)
+            for (metric, extra_labels), value in recorder.counters().items():
+                metric.set(labels + extra_labels, value)
+
+    async def run(self):
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0))
+        self.poll_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.poll_connection_limit)
+        )
+        metrics_server = None
+        if self.metrics_port:
+            metrics.REGISTRY.add_collector(self.collect_metrics)
+            metrics_server = metrics.MetricsServer(port=self.metrics_port)
+            await metrics_server.start()
+        for room in self.room_ids:
+            if self.per_room_dirs:
+                dirs = {
+                    "tmp_dir": "{}rooms/{}/".format(tmp_dir, room),
+                    "archive_dir": "{}{}/".format(archive_dir, room),
+                }
+            else:
+                dirs = {"tmp_dir": tmp_dir, "archive_dir": archive_dir}
+            self.rooms[room] = RoomRecorder(
+                room, self.session, bark_token=self.bark_token, **dirs
+            )
+        # spread the first polls over one interval to avoid request bursts
+        step = self.poll_interval / max(len(self.rooms), 1)
+        watchers = [
+            asyncio.ensure_future(self._watch(recorder, index * step))
+            for index, recorder in enumerate(self.rooms.values())
+        ]
+        try:
+            await asyncio.gather(*watchers)
+        finally:
+            for watcher in watchers:
+                watcher.cancel()
+            await asyncio.gather(
+                *(recorder.close() for recorder in self.rooms.values()),
+                return_exceptions=True
+            )
+            if metrics_server is not None:
+                await metrics_server.stop()
+            await self.session.close()
+            await self.poll_session.close()
+
+    async def _watch(self, recorder: RoomRecorder, delay):
+        await asyncio.sleep(delay)
+        async for status, live_start_time in poll_room_status(
+            self.poll_session, recorder.room_id, self.poll_interval
+        ):
+            try:
+                await recorder.update(status, live_start_time)
+            except Exception as e:
+                logger.error(
+                    "Unknown error {} occur, detail: \n{}".format(
+                        e, traceback.format_exc(limit=2)
+                    )
+                )
+                sentry_logger.exception("Error when updating room", extra=e)
 
 
-def send_notif_bark(bark_token):
+def send_notif_bark(bark_token, room=room_id_defalut):
     if bark_token is not None:
         title = "ZBL"
-        url = "https://live.bilibili.com/92613"
+        url = "https://live.bilibili.com/{}".format(room)
         try:
             logger.info("Sending notification to bark {}".format(bark_token))
             rq.get("https://api.day.app/{}/{}?url={}".format(bark_token, title, url))
@@ -220,7 +726,46 @@ if __name__ == "__main__":
     env_dsn = os.getenv("DSN", None)
     env_roomid = os.getenv("ROOMID", room_id_defalut)
     env_bark_token = os.getenv("BARK_TOKEN")
+    env_flush_count = os.getenv("FLUSH_COUNT", writer_config["max_count"])
+    env_flush_delay = os.getenv("FLUSH_DELAY", writer_config["max_delay"])
+    env_durability = os.getenv("DURABILITY", DurabilityPolicy.FLUSH.value)
+    archive_format = os.getenv("ARCHIVE_FORMAT", archive_format).lower()
+    mongo_sink_enabled = os.getenv("MONGO_SINK", "").lower() in ("1", "true", "yes")
+    env_metrics_port = os.getenv("METRICS_PORT", metrics_port)
+    env_poll_connections = os.getenv("POLL_CONNECTIONS", poll_connection_limit)
+    env_queue_size = os.getenv("QUEUE_SIZE", queue_config["maxsize"])
+    env_queue_overflow = os.getenv("QUEUE_OVERFLOW", queue_config["overflow"].value)
     log_config(env_log_level, env_log_path, env_dsn)
+    try:
+        writer_config["max_count"] = int(env_flush_count)
+        writer_config["max_delay"] = float(env_flush_delay)
+        writer_config["policy"], writer_config["fsync_interval"] = parse_durability(
+            env_durability
+        )
+    except ValueError:
+        logger.error(
+            "FLUSH_COUNT, FLUSH_DELAY or DURABILITY error, use default writer config"
+        )
+    try:
+        queue_config["maxsize"] = int(env_queue_size)
+        queue_config["overflow"] = OverflowPolicy(env_queue_overflow.lower())
+    except ValueError:
+        logger.error("QUEUE_SIZE or QUEUE_OVERFLOW error, use default queue config")
+    if archive_format not in ARCHIVE_FORMATS:
+        logger.error(
+            "ARCHIVE_FORMAT {} error, should be one of {}, use jsonl".format(
+                archive_format, ", ".join(ARCHIVE_FORMATS)
+            )
+        )
+        archive_format = "jsonl"
+    try:
+        poll_connection_limit = int(env_poll_connections)
+    except ValueError:
+        logger.error("POLL_CONNECTIONS error, use {}".format(poll_connection_limit))
+    try:
+        metrics_port = int(env_metrics_port) if env_metrics_port else None
+    except ValueError:
+        logger.error("METRICS_PORT error, metrics are not served")
     room_id = room_id_defalut
 
     logger.info("------------- Run argument -------------")
@@ -229,8 +774,42 @@ if __name__ == "__main__":
     logger.info(log_format("Log path:", env_log_path))
     logger.info(log_format("Bark token:", env_bark_token))
     logger.info(log_format("DSN:", env_dsn))
+    logger.info(log_format("Flush count:", writer_config["max_count"]))
+    logger.info(log_format("Flush delay:", writer_config["max_delay"]))
+    logger.info(log_format("Durability:", env_durability))
+    logger.info(log_format("Archive format:", archive_format))
+    logger.info(log_format("Queue size:", queue_config["maxsize"]))
+    logger.info(log_format("Queue overflow:", queue_config["overflow"].value))
+    logger.info(log_format("Mongo sink:", mongo_sink_enabled))
+    logger.info(log_format("Poll connections:", poll_connection_limit))
+    logger.info(log_format("Metrics port:", metrics_port))
     logger.info("------------- End argument -------------")
 
+    if mongo_sink_enabled:
+        mongo.db_connect()
+
+    room_ids = str(env_roomid).split(",")
+    if len(room_ids) > 1:
+        # multi-room mode, every room shares one event loop and its sessions
+        try:
+            room_ids = [int(i) for i in room_ids if i.strip()]
+        except ValueError:
+            logger.error(
+                "ROOMID error, please reset this envirment.get ROOMID: {}".format(
+                    env_roomid
+                )
+            )
+            sys.exit(1)
+        logger.info("start record, record room ids are {}".format(room_ids))
+        recorder = MultiRoomRecorder(
+            room_ids,
+            bark_token=env_bark_token,
+            poll_connection_limit=poll_connection_limit,
+            metrics_port=metrics_port,
+        )
+        asyncio.get_event_loop().run_until_complete(recorder.run())
+        sys.exit(0)
+
     try:
         room_id = int(env_roomid)
     except ValueError:
@@ -243,45 +822,11 @@ if __name__ == "__main__":
         logger.warning("Your are using the default room id: {}".format(room_id_defalut))
     logger.info("start record, record room id is {}".format(room_id))
 
-    while True:
-        time_s = time.time()
-        time.sleep(5)
-        try:
-            resp = rq.get(
-                "https://api.live.bilibili.com/xlive/web-room/v1/index/getInfoByRoom?room_id={}".format(
-                    room_id
-                )
-            )
-            status = resp.json()["data"]["room_info"]["live_status"]
-            logger.debug(
-                "room status resp is:{} use time:{}".format(
-                    resp.json(), time.time() - time_s
-                )
-            )
-            if status == 1:
-                live_start_time = resp.json()["data"]["room_info"]["live_start_time"]
-                send_notif_bark(env_bark_token)
-                asyncio.get_event_loop().run_until_complete(main_loop(live_start_time))
-                time.sleep(20)  # Maybe would not return None after live end
-        except TypeError as e:
-            logger.debug(
-                "Fail to get the room ({}) status, will try soon, detail {}".format(
-                    room_id, e
-                ),
-            )
-            time.sleep(10)
-        except json.decoder.JSONDecodeError as e:
-            logger.debug(
-                "Fail to get the room ({}) status, will try soon, detail {}".format(
-                    room_id, e
-                ),
-            )
-            logger.debug("Respond content is {}".format(resp.content))
-        except Exception as e:
-            logger.error(
-                "Unknown error {} occur, detail: \n{}".format(
-                    e, traceback.format_exc(limit=2)
-                )
-            )
-            # sentry_logger.exception("Error when getting room info", extra=e)
-            time.sleep(10)
+    recorder = MultiRoomRecorder(
+        [room_id],
+        bark_token=env_bark_token,
+        per_room_dirs=False,
+        poll_connection_limit=poll_connection_limit,
+        metrics_port=metrics_port,
+    )
+    asyncio.get_event_loop().run_until_complete(recorder.run())
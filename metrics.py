@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal Prometheus metrics: counters, gauges and histograms rendered in the
+text exposition format, served over aiohttp from the recorder's event loop
+
+    commands = Counter("danmaku_commands_total", "Commands received", ("room", "cmd"))
+    commands.inc(("92613", "DANMU_MSG"))
+    await MetricsServer(port=9100).start()  # GET /metrics
+"""
+import logging
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(name, _escape(value)) for name, value in zip(names, values)
+    ) + "}"
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    metric_type = "untyped"
+
+    def __init__(self, name, documentation, labelnames: Sequence[str] = (), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, object] = {}
+        (REGISTRY if registry is None else registry).register(self)
+
+    def remove(self, labels: Tuple):
+        self._values.pop(labels, None)
+
+    def samples(self) -> List[Tuple[str, Tuple, Tuple, object]]:
+        """
+        (suffix, extra label names, label values, value) of every sample
+        """
+        return [("", (), labels, value) for labels, value in list(self._values.items())]
+
+    def render(self) -> str:
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.metric_type),
+        ]
+        for suffix, extra_names, labels, value in self.samples():
+            lines.append(
+                "{}{}{} {}".format(
+                    self.name,
+                    suffix,
+                    _format_labels(self.labelnames + extra_names, labels),
+                    _format_value(value),
+                )
+            )
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def inc(self, labels: Tuple = (), amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def set(self, labels: Tuple, value):
+        """
+        For counters kept elsewhere and copied at scrape time
+        """
+        self._values[labels] = value
+
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def set(self, labels: Tuple, value):
+        self._values[labels] = value
+
+
+class Histogram(Metric):
+    """
+    @description: Cumulative bucket histogram, observe is thread safe so a
+    writer thread can report into it
+    """
+
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+
+    def observe(self, labels: Tuple, value):
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # per bucket counts (the last one is +Inf), sum
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][bisect_left(self.buckets, value)] += 1
+            state[1] += value
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            items = [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+        for labels, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append(("_bucket", ("le",), labels + (_format_value(bound),), cumulative))
+            samples.append(("_sum", (), labels, total))
+            samples.append(("_count", (), labels, cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+        self.collectors: List[Callable[[], None]] = []
+
+    def register(self, metric: Metric):
+        self.metrics.append(metric)
+
+    def add_collector(self, collector: Callable[[], None]):
+        """
+        collector() runs before every scrape, to copy values kept elsewhere
+        """
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.error("Metrics collector failed, detail: {}".format(e))
+        return "".join(metric.render() for metric in self.metrics)
+
+
+REGISTRY = Registry()
+
+
+class MetricsServer:
+    """
+    @description: Serve GET /metrics of a registry on the running event loop
+    """
+
+    def __init__(self, host="0.0.0.0", port=9100, registry=REGISTRY):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self._runner = None
+        self.app = web.Application()
+        self.app.router.add_get("/metrics", self.handle)
+
+    async def handle(self, request: web.Request):
+        return web.Response(
+            body=self.registry.render().encode("utf-8"), headers={"Content-Type": CONTENT_TYPE}
+        )
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info("Metrics served on http://{}:{}/metrics".format(self.host, self.port))
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
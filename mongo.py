@@ -4,7 +4,7 @@ from typing import Collection
 
 import pymongo
 from pymongo.database import Database
-from pymongo.errors import ConnectionFailure
+from pymongo.errors import ConnectionFailure, OperationFailure
 from pymongo.mongo_client import MongoClient
 
 
@@ -30,6 +30,7 @@ class MongoDB(object):
             exit(1)
         else:
             logging.info("Connect success")
+            ensure_indexes(self.mongo_client)
 
 
 db = MongoDB()
@@ -52,3 +53,57 @@ def get_data_col(client: MongoClient):
     db: Database = client["bili_danmaku"]
     data_col: Collection = db["data"]
     return data_col
+
+
+def get_live_col(client: MongoClient):
+    """
+    danmaku recorded live by main.py, see mongo_sink.py
+    """
+    db: Database = client["bili_danmaku"]
+    live_col: Collection = db["live"]
+    return live_col
+
+
+def ensure_indexes(client: MongoClient):
+    """
+    create_index is a no-op when the index exists, so this runs on every connect
+    """
+    try:
+        get_info_col(client).create_index([("rid", pymongo.ASCENDING)], unique=True)
+    except OperationFailure as e:
+        # duplicated rid written before the index existed
+        logging.error("Can not create the unique rid index, msg: {}".format(e.args))
+    get_data_col(client).create_index(
+        [("creator", pymongo.ASCENDING), ("ts", pymongo.ASCENDING)]
+    )
+    get_live_col(client).create_index(
+        [("room_id", pymongo.ASCENDING), ("timestamp", pymongo.ASCENDING)]
+    )
+
+
+def find_record(client: MongoClient, rid: str):
+    return get_info_col(client).find_one({"rid": rid})
+
+
+def iter_danmaku(client: MongoClient, creator, start=None, end=None, batch_size=1000):
+    """
+    danmaku of a record with start < ts < end (millisecond from the record
+    start, None for no bound), sorted by ts and streamed through a cursor
+    on the (creator, ts) index
+    """
+    query = {"creator": creator}
+    ts = {}
+    if start is not None:
+        ts["$gt"] = start
+    if end is not None:
+        ts["$lt"] = end
+    if ts:
+        query["ts"] = ts
+    cursor = (
+        get_data_col(client)
+        .find(query, {"_id": 0, "ts": 1, "text": 1, "dm_mode": 1, "dm_fontsize": 1, "dm_color": 1})
+        .sort("ts", pymongo.ASCENDING)
+        .batch_size(batch_size)
+    )
+    with cursor:
+        yield from cursor
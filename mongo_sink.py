@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from bson.objectid import ObjectId
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError
+
+import jsoncodec
+from writer import GroupCommitWriter
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+class MongoSink:
+    """
+    @description: Batch live danmaku into insert_many, a batch is sent when it
+    holds max_count documents or its oldest document is max_delay old. Inserts
+    run one at a time on a worker thread so the event loop never waits for
+    the database. When the database falls behind by max_pending documents,
+    or an insert fails, documents are spilled to a json lines file instead,
+    see replay_spill
+    """
+
+    def __init__(
+        self,
+        collection: Collection,
+        spill_path,
+        max_count=500,
+        max_delay=1.0,
+        max_pending=20000,
+        loop=None,
+    ):
+        """
+        :param collection: collection the documents are inserted into
+        :param spill_path: json lines file of the documents not inserted
+        :param max_count: send a batch when this many documents are buffered
+        :param max_delay: send a batch when the oldest buffered document is this old (second)
+        :param max_pending: spill when this many documents are buffered or being inserted
+        :param loop: event loop for the batch timers
+        """
+        self.collection = collection
+        self.spill_path = spill_path
+        self.max_count = max_count
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        # one thread keeps the batches in order and bounds the database load
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        # spills get their own thread, they must not wait behind a slow insert
+        self._spill_executor = ThreadPoolExecutor(max_workers=1)
+        self._buffer: List[dict] = []
+        self._inserting = 0
+        self._futures = set()
+        self._commit_handle = None
+        self._spill = None  # GroupCommitWriter of the spill thread, opened on the first spill
+
+        self.inserted = 0
+        self.spilled = 0
+        self.closed = False
+
+    @property
+    def pending(self):
+        """
+        Documents buffered or being inserted
+        """
+        return len(self._buffer) + self._inserting
+
+    def write(self, doc: dict):
+        if self.closed:
+            raise ValueError("write to closed sink {}".format(self.collection.full_name))
+        if self.pending >= self.max_pending:
+            # the database is too slow, keep the event loop and memory bounded
+            self._spill_docs([doc])
+            return
+        self._buffer.append(doc)
+        if len(self._buffer) >= self.max_count:
+            self.commit()
+        elif self._commit_handle is None:
+            self._commit_handle = self._loop.call_later(self.max_delay, self.commit)
+
+    def commit(self):
+        if self._commit_handle is not None:
+            self._commit_handle.cancel()
+            self._commit_handle = None
+        if not self._buffer:
+            return
+        batch, self._buffer = self._buffer, []
+        self._inserting += len(batch)
+        future = self._loop.run_in_executor(self._executor, self._insert, batch)
+        self._futures.add(future)
+        future.add_done_callback(functools.partial(self._on_inserted, batch))
+
+    def _insert(self, batch: List[dict]):
+        self.collection.insert_many(batch, ordered=False)
+
+    def _on_inserted(self, batch: List[dict], future: asyncio.Future):
+        self._futures.discard(future)
+        self._inserting -= len(batch)
+        if future.cancelled():
+            self._spill_docs(batch)
+        elif future.exception() is not None:
+            logger.error(
+                "Fail to insert {} danmaku into {}, spill them to {}, detail: {}".format(
+                    len(batch), self.collection.full_name, self.spill_path, future.exception()
+                )
+            )
+            self._spill_docs(batch)
+        else:
+            self.inserted += len(batch)
+
+    def _spill_docs(self, docs: List[dict]):
+        # file io stays off the event loop, like the inserts
+        future = self._loop.run_in_executor(self._spill_executor, self._write_spill, docs)
+        self._futures.add(future)
+        future.add_done_callback(functools.partial(self._on_spilled, docs))
+        self.spilled += len(docs)
+
+    def _on_spilled(self, docs: List[dict], future: asyncio.Future):
+        self._futures.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(
+                "Fail to spill {} danmaku to {}, detail: {}".format(
+                    len(docs), self.spill_path, future.exception()
+                )
+            )
+            self.spilled -= len(docs)
+
+    def _write_spill(self, docs: List[dict]):
+        if self._spill is None:
+            self._spill = GroupCommitWriter(self.spill_path, timers=False)
+            logger.warning(
+                "Mongo sink falls behind, spill danmaku to {}".format(self.spill_path)
+            )
+        for doc in docs:
+            # insert_many already gave the document its _id, keep it so a
+            # replay does not duplicate what a failed batch partly inserted
+            if "_id" in doc:
+                doc = dict(doc, _id=str(doc["_id"]))
+            self._spill.write_record(doc)
+        self._spill.commit()
+
+    async def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.commit()
+        # inserts that fail while closing spill, wait until those are written too
+        while self._futures:
+            await asyncio.wait(list(self._futures))
+        self._executor.shutdown(wait=False)
+        if self._spill is not None:
+            await self._loop.run_in_executor(self._spill_executor, self._spill.close)
+        self._spill_executor.shutdown(wait=False)
+        logger.info(
+            "Mongo sink {} closed, {} inserted, {} spilled".format(
+                self.collection.full_name, self.inserted, self.spilled
+            )
+        )
+
+
+def replay_spill(collection: Collection, path, batch_size=1000) -> int:
+    """
+    @description: Insert the documents of a spill file, documents already in
+    the collection are skipped. Returns the number of inserted documents
+    """
+    inserted = 0
+    batch = []
+
+    def insert(batch):
+        try:
+            return len(collection.insert_many(batch, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            errors = e.details["writeErrors"]
+            if any(error["code"] != DUPLICATE_KEY_ERROR for error in errors):
+                raise
+            return e.details["nInserted"]
+
+    with open(path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            doc = jsoncodec.loads(line)
+            if "_id" in doc:
+                doc["_id"] = ObjectId(doc["_id"])
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                inserted += insert(batch)
+                batch = []
+    if batch:
+        inserted += insert(batch)
+    return inserted
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded queue between the websocket decoder and the blocking sinks
+
+The event loop only appends decoded records, one thread hands them to the
+sinks in batches, so a slow or stalled disk never holds up websocket frames
+and heartbeats. What happens when the queue is full is the OverflowPolicy.
+"""
+import asyncio
+import collections
+import enum
+import logging
+import os
+import threading
+import time
+from typing import Callable, Deque, Dict, List
+
+import jsoncodec
+
+logger = logging.getLogger(__name__)
+
+
+class OverflowPolicy(enum.Enum):
+    BLOCK = "block"  # stop reading frames until the queue has room again
+    # move the overflow to a spill file, read back once the queue has room. Drops
+    # records when the spill thread falls maxsize records behind, see spill_dropped
+    SPILL = "spill"
+    DROP = "drop"  # drop the lowest priority record
+
+
+class RecordQueue:
+    """
+    @description: Bounded record queue drained by a sink thread. put is called
+    on the event loop, handler(records) in the thread, with an empty list every
+    tick_interval when idle so the handler can commit on time.
+
+    With SPILL overflow a second thread appends the overflow to the spill file,
+    so neither the event loop nor a stalled handler waits for it. Once spilling
+    started every record goes through the spill file until the sink thread has
+    read it back, which keeps the records in order. A spill file left by a
+    crash is read back first
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[List], None],
+        maxsize=10000,
+        overflow=OverflowPolicy.BLOCK,
+        spill_path=None,
+        batch_size=512,
+        tick_interval=0.2,
+        loop=None,
+        name="sink",
+    ):
+        """
+        :param handler: called in the sink thread with a list of records
+        :param maxsize: max queued records, BLOCK may exceed it by one frame.
+            SPILL also holds at most maxsize records waiting for the spill file,
+            and drops the records beyond that
+        :param overflow: overflow policy
+        :param spill_path: spill file of SPILL policy
+        :param batch_size: max records of one handler call
+        :param tick_interval: max interval between two handler calls (second)
+        :param loop: event loop that put and wait_for_room run on
+        """
+        if overflow is OverflowPolicy.SPILL and spill_path is None:
+            raise ValueError("SPILL overflow policy needs a spill_path")
+        self.handler = handler
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.spill_path = spill_path
+        self.batch_size = batch_size
+        self.tick_interval = tick_interval
+        self.name = name
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+
+        # priority -> records, drained from the highest priority
+        self._queues: Dict[int, Deque] = {}
+        self._size = 0
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._drain, name=name, daemon=True)
+        self._closing = False
+        self.closed = False
+        self._room = asyncio.Event()
+        self._room.set()
+
+        # spill file state, guarded by _cond. The spill thread owns the writing
+        # handle, the sink thread the reading one
+        self._spill_thread = None
+        self._overflow: Deque = collections.deque()  # records not in the spill file yet
+        self._spill_pending = 0  # records in _overflow or in the file, not read back
+        self._spill_end = 0  # bytes of complete lines in the spill file
+        self._spill_offset = 0  # bytes read back
+        self._spill_reset = False  # everything was read back, truncate before writing
+        self._spill_writer = None
+        self._spill_reader = None
+
+        self.max_depth = 0
+        self.dropped = collections.Counter()  # priority -> dropped records
+        self.spilled = 0
+        self.spill_dropped = 0  # SPILL records dropped while the spill thread lags
+        self.blocked_seconds = 0.0
+        self.handled = 0
+        self.failed = 0  # records the handler raised on, or lost by the spill file
+
+    @property
+    def depth(self):
+        return self._size
+
+    @property
+    def full(self):
+        return self._size >= self.maxsize
+
+    def stats(self) -> dict:
+        return {
+            "depth": self._size,
+            "max_depth": self.max_depth,
+            "handled": self.handled,
+            "failed": self.failed,
+            "dropped": sum(self.dropped.values()),
+            "dropped_by_priority": dict(self.dropped),
+            "spilled": self.spilled,
+            "spill_dropped": self.spill_dropped,
+            "spill_pending": self._spill_pending,
+            "blocked_seconds": self.blocked_seconds,
+        }
+
+    def start(self):
+        if self.spill_path is not None and os.path.exists(self.spill_path):
+            self._recover_spill()
+        if self.overflow is OverflowPolicy.SPILL:
+            self._spill_thread = threading.Thread(
+                target=self._write_spill, name=self.name + " spill", daemon=True
+            )
+            self._spill_thread.start()
+        self._thread.start()
+
+    def put(self, record, priority=0) -> bool:
+        """
+        @description: Queue a record, False if it was dropped
+        """
+        with self._cond:
+            if self.overflow is OverflowPolicy.SPILL and (
+                self._spill_pending or self._size >= self.maxsize
+            ):
+                return self._spill(record, priority)
+            if self._size >= self.maxsize:
+                if self.overflow is OverflowPolicy.DROP:
+                    queued = [p for p, q in self._queues.items() if q]
+                    if not queued or min(queued) >= priority:
+                        self.dropped[priority] += 1
+                        return False
+                    lowest = min(queued)
+                    self._queues[lowest].popleft()
+                    self._size -= 1
+                    self.dropped[lowest] += 1
+                # BLOCK keeps the record, the next frame waits in wait_for_room
+            queue = self._queues.get(priority)
+            if queue is None:
+                queue = self._queues[priority] = collections.deque()
+            queue.append(record)
+            self._size += 1
+            if self._size > self.max_depth:
+                self.max_depth = self._size
+            if self._size >= self.maxsize:
+                self._room.clear()
+            self._cond.notify_all()
+        return True
+
+    async def wait_for_room(self):
+        """
+        @description: Wait until the queue has room again, only BLOCK waits
+        """
+        if self.overflow is not OverflowPolicy.BLOCK or self._room.is_set():
+            return
+        time_s = time.monotonic()
+        logger.warning("Queue {} is full, stop reading until it drains".format(self.name))
+        await self._room.wait()
+        self.blocked_seconds += time.monotonic() - time_s
+
+    def _spill(self, record, priority) -> bool:
+        # called with _cond held, the file is written by the spill thread
+        if len(self._overflow) >= self.maxsize:
+            # the spill file can not keep up either, keep the memory bounded
+            self.spill_dropped += 1
+            return False
+        if not self._spill_pending:
+            logger.warning(
+                "Queue {} is full, spill records to {}".format(self.name, self.spill_path)
+            )
+        self._overflow.append(record)
+        self._spill_pending += 1
+        self.spilled += 1
+        self._cond.notify_all()
+        return True
+
+    def _write_spill(self):
+        while True:
+            with self._cond:
+                while not self._overflow and not self._closing:
+                    self._cond.wait()
+                if not self._overflow:
+                    return
+                records = list(self._overflow)
+                self._overflow.clear()
+                reset, self._spill_reset = self._spill_reset, False
+            data = "".join(jsoncodec.dumps(record) + "\n" for record in records).encode("utf-8")
+            try:
+                if self._spill_writer is None:
+                    self._spill_writer = open(self.spill_path, "ab")
+                if reset:
+                    self._spill_writer.truncate(0)
+                self._spill_writer.write(data)
+                self._spill_writer.flush()
+            except (IOError, ValueError) as e:
+                logger.error(
+                    "Queue {} fails to spill {} records, detail: {}".format(
+                        self.name, len(records), e
+                    )
+                )
+                with self._cond:
+                    self._spill_pending -= len(records)
+                    self.failed += len(records)
+                    self._cond.notify_all()
+                continue
+            with self._cond:
+                self._spill_end += len(data)
+                self._cond.notify_all()
+
+    def _recover_spill(self):
+        """
+        @description: Read back the spill file of a crashed run before any new
+        record, a line cut short by the crash is dropped
+        """
+        with open(self.spill_path, "rb+") as f:
+            data = f.read()
+            end = data.rfind(b"\n") + 1
+            if end < len(data):
+                f.truncate(end)
+        if not end:
+            os.remove(self.spill_path)
+            return
+        self._spill_end = end
+        self._spill_pending = data.count(b"\n", 0, end)
+        logger.warning(
+            "Queue {} recovers {} spilled records from {}".format(
+                self.name, self._spill_pending, self.spill_path
+            )
+        )
+
+    def _spill_readable(self):
+        return self._spill_offset < self._spill_end
+
+    def _read_spill(self) -> List:
+        # sink thread only, every spilled line is complete up to _spill_end
+        with self._cond:
+            end = self._spill_end
+        if self._spill_reader is None:
+            self._spill_reader = open(self.spill_path, "rb")
+        self._spill_reader.seek(self._spill_offset)
+        records = []
+        lines = 0
+        while lines < self.batch_size and self._spill_offset < end:
+            line = self._spill_reader.readline()
+            self._spill_offset += len(line)
+            lines += 1
+            try:
+                records.append(jsoncodec.loads(line))
+            except ValueError:
+                logger.error("Queue {} skips a broken spilled record".format(self.name))
+                self.failed += 1
+        with self._cond:
+            self._spill_pending -= lines
+            if not self._spill_pending:
+                # start the next spill from an empty file
+                self._spill_reader.close()
+                self._spill_reader = None
+                self._spill_offset = self._spill_end = 0
+                self._spill_reset = True
+            self._cond.notify_all()
+        return records
+
+    def _take(self) -> List:
+        records = []
+        for priority in sorted(self._queues, reverse=True):
+            queue = self._queues[priority]
+            while queue and len(records) < self.batch_size:
+                records.append(queue.popleft())
+        self._size -= len(records)
+        if self._size < self.maxsize and not self._room.is_set():
+            self._loop.call_soon_threadsafe(self._room.set)
+        return records
+
+    def _handle(self, records):
+        try:
+            self.handler(records)
+        except Exception as e:
+            logger.exception("Queue {} handler failed, detail: {}".format(self.name, e))
+            self.failed += len(records)
+            return
+        self.handled += len(records)
+
+    def _drain(self):
+        while True:
+            with self._cond:
+                done = self._closing and not self._size and not self._spill_pending
+                if not (self._size or self._spill_readable() or done):
+                    self._cond.wait(self.tick_interval)
+                records = self._take()
+                # the spilled records are older than anything queued after them
+                read_spill = not records and self._spill_readable()
+                done = self._closing and not self._size and not self._spill_pending
+            if read_spill:
+                records = self._read_spill()
+            self._handle(records)
+            if done and not read_spill:
+                return
+
+    def close(self):
+        """
+        @description: Drain the queue and the spill file, then remove the
+        spill file. Blocking, see aclose
+        """
+        if self.closed:
+            return
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        if self._spill_thread is not None and self._spill_thread.is_alive():
+            self._spill_thread.join()
+        if self._thread.is_alive():
+            self._thread.join()
+        if self._spill_writer is not None:
+            self._spill_writer.close()
+            self._spill_writer = None
+        if self._spill_reader is not None:
+            self._spill_reader.close()
+            self._spill_reader = None
+        if self.spill_path is not None and not self._spill_pending:
+            try:
+                os.remove(self.spill_path)
+            except FileNotFoundError:
+                pass
+        self.closed = True
+        logger.info("Queue {} closed, {}".format(self.name, self.stats()))
+
+    async def aclose(self):
+        await self._loop.run_in_executor(None, self.close)
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+Video duration read from the container header, FLV and MP4 only touch a few
+kilobytes of the file. Anything else falls back to OpenCV when it is installed.
+
+Durations are cached in a json file keyed by the absolute path, the size and the
+mtime of the video, so probing an unchanged directory again does not open any video.
+"""
+import json
+import logging
+import os
+import re
+import struct
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = "./.video_duration_cache.json"
+
+FLV_TAG_HEADER_SIZE = 11
+FLV_TAG_SCRIPT = 18
+FLV_TAG_TYPES = (8, 9, FLV_TAG_SCRIPT)  # audio, video, script
+# every position that may start a tag header: a known type, then the stream id 0
+FLV_TAG_PATTERN = re.compile(b"(?=[\x08\x09\x12].{7}\x00\x00\x00)", re.S)
+FLV_SCAN_BYTES = 4 * 1024 * 1024  # the last complete tag of a cut recording starts in it
+FLV_DURATION_KEY = b"\x00\x08duration\x00"  # amf0 key "duration" with a number value
+MP4_BOX_STRUCT = struct.Struct(">I4s")
+
+
+def flv_duration(path) -> int:
+    """
+    @description: Duration in millisecond, from onMetaData when it is set,
+    otherwise the timestamp span of the tags (live recordings keep duration 0)
+    """
+    with open(path, "rb") as f:
+        header = f.read(9)
+        if len(header) < 9 or header[:3] != b"FLV":
+            raise ValueError("{} is not a flv file".format(path))
+        header_size, = struct.unpack(">I", header[5:9])
+        f.seek(header_size + 4)  # skip PreviousTagSize0
+        tag = f.read(FLV_TAG_HEADER_SIZE)
+        if len(tag) < FLV_TAG_HEADER_SIZE:
+            raise ValueError("{} has no flv tag".format(path))
+        first_timestamp = _flv_timestamp(tag)
+        if tag[0] == FLV_TAG_SCRIPT:
+            data_size = int.from_bytes(tag[1:4], "big")
+            script = f.read(data_size)
+            index = script.find(FLV_DURATION_KEY)
+            if index >= 0:
+                start = index + len(FLV_DURATION_KEY)
+                duration, = struct.unpack(">d", script[start:start + 8])
+                if duration > 0:
+                    return int(duration * 1000)
+            next_tag = f.read(4 + FLV_TAG_HEADER_SIZE)[4:]
+            if len(next_tag) == FLV_TAG_HEADER_SIZE:
+                first_timestamp = _flv_timestamp(next_tag)
+
+        # the file ends with the PreviousTagSize of its last tag, unless the
+        # recording was killed in the middle of a tag
+        f.seek(0, os.SEEK_END)
+        file_size = f.tell()
+        data_start = header_size + 4
+        f.seek(-4, os.SEEK_END)
+        last_tag_size, = struct.unpack(">I", f.read(4))
+        offset = file_size - 4 - last_tag_size
+        last_tag = None
+        if data_start <= offset:
+            f.seek(offset)
+            last_tag = f.read(FLV_TAG_HEADER_SIZE)
+            if not _is_flv_tag(last_tag, last_tag_size):
+                last_tag = None
+        if last_tag is None:
+            last_tag = _find_last_flv_tag(f, data_start, file_size)
+        if last_tag is None:
+            raise ValueError("{} has no complete flv tag".format(path))
+        return _flv_timestamp(last_tag) - first_timestamp
+
+
+def _is_flv_tag(tag: bytes, tag_size=None) -> bool:
+    """
+    A tag header of a known type with a zero stream id, whose DataSize matches
+    the PreviousTagSize following the tag when it is given
+    """
+    if len(tag) < FLV_TAG_HEADER_SIZE or tag[0] not in FLV_TAG_TYPES:
+        return False
+    if tag[8:11] != b"\0\0\0":
+        return False
+    return tag_size is None or int.from_bytes(tag[1:4], "big") + FLV_TAG_HEADER_SIZE == tag_size
+
+
+def _find_last_flv_tag(f, data_start, file_size):
+    """
+    Scan the tail backwards for the last tag that is followed by its own
+    PreviousTagSize, the header of that tag or None
+    """
+    start = max(data_start, file_size - FLV_SCAN_BYTES)
+    f.seek(start)
+    tail = f.read(file_size - start)
+    candidates = [m.start() for m in FLV_TAG_PATTERN.finditer(tail)]
+    for offset in reversed(candidates):
+        tag = tail[offset:offset + FLV_TAG_HEADER_SIZE]
+        end = offset + FLV_TAG_HEADER_SIZE + int.from_bytes(tag[1:4], "big")
+        if end + 4 > len(tail):
+            continue
+        if _is_flv_tag(tag, int.from_bytes(tail[end:end + 4], "big")):
+            return tag
+    return None
+
+
+def _flv_timestamp(tag: bytes) -> int:
+    # 24 bits timestamp followed by its upper 8 bits
+    return int.from_bytes(tag[7:8] + tag[4:7], "big")
+
+
+def _iter_mp4_boxes(f, start, end):
+    offset = start
+    while offset + MP4_BOX_STRUCT.size <= end:
+        f.seek(offset)
+        size, box_type = MP4_BOX_STRUCT.unpack(f.read(MP4_BOX_STRUCT.size))
+        header_size = MP4_BOX_STRUCT.size
+        if size == 1:
+            size, = struct.unpack(">Q", f.read(8))
+            header_size += 8
+        elif size == 0:
+            size = end - offset
+        if size < header_size:
+            raise ValueError("broken mp4 box {} at {}".format(box_type, offset))
+        yield box_type, offset + header_size, offset + size
+        offset += size
+
+
+def mp4_duration(path) -> int:
+    """
+    @description: Duration in millisecond, from the movie header box moov/mvhd
+    """
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        file_size = f.tell()
+        for box_type, start, end in _iter_mp4_boxes(f, 0, file_size):
+            if box_type != b"moov":
+                continue
+            for sub_type, sub_start, _ in _iter_mp4_boxes(f, start, end):
+                if sub_type != b"mvhd":
+                    continue
+                f.seek(sub_start)
+                version = f.read(1)[0]
+                if version == 1:
+                    f.seek(3 + 16, os.SEEK_CUR)
+                    timescale, duration = struct.unpack(">IQ", f.read(12))
+                else:
+                    f.seek(3 + 8, os.SEEK_CUR)
+                    timescale, duration = struct.unpack(">II", f.read(8))
+                return duration * 1000 // timescale
+    raise ValueError("{} has no mp4 movie header".format(path))
+
+
+def cv2_duration(path) -> int:
+    if cv2 is None:
+        raise ValueError(
+            "Cannot probe {}, only flv and mp4 are supported without opencv".format(path)
+        )
+    cap = cv2.VideoCapture(path)
+    try:
+        return int((cap.get(cv2.CAP_PROP_FRAME_COUNT) / cap.get(cv2.CAP_PROP_FPS)) * 1000)
+    finally:
+        cap.release()
+
+
+PROBES = {
+    b"FLV": flv_duration,
+    b"ftyp": mp4_duration,
+}
+
+
+def probe_duration(path) -> int:
+    """
+    @description: Duration of a video in millisecond, the container is detected
+    from the first bytes, not the extension
+    """
+    with open(path, "rb") as f:
+        head = f.read(8)
+    probe = PROBES.get(head[:3]) or PROBES.get(head[4:8]) or cv2_duration
+    try:
+        return probe(path)
+    except (ValueError, struct.error, IndexError, ZeroDivisionError, OSError) as e:
+        if probe is cv2_duration or cv2 is None:
+            raise
+        logger.warning("Fail to read the header of {}, use opencv: {}".format(path, e))
+        return cv2_duration(path)
+
+
+class DurationCache:
+    """
+    @description: Persistent probe_duration results, an entry is reused while
+    the size and mtime of the video are unchanged
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        try:
+            with open(path, "r") as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            logger.warning("Ignore broken duration cache {}".format(path))
+
+    def duration(self, video_path) -> int:
+        key = os.path.abspath(video_path)
+        stat = os.stat(video_path)
+        entry = self.entries.get(key)
+        if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+            return entry["duration"]
+        duration = probe_duration(video_path)
+        self.entries[key] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "duration": duration}
+        self.dirty = True
+        return duration
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic websocket traffic shared by benchmark.py and fake_server.py
+"""
+import json
+import random
+import time
+import zlib
+
+import blivedm
+from blivedm import HEADER_STRUCT, Operation
+
+WS_BODY_PROTOCOL_VERSION_NORMAL = blivedm.WS_BODY_PROTOCOL_VERSION_NORMAL
+WS_BODY_PROTOCOL_VERSION_DEFLATE = blivedm.WS_BODY_PROTOCOL_VERSION_DEFLATE
+WS_BODY_PROTOCOL_VERSION_BROTLI = blivedm.WS_BODY_PROTOCOL_VERSION_BROTLI
+
+COMPRESSORS = {WS_BODY_PROTOCOL_VERSION_DEFLATE: zlib.compress}
+if blivedm.brotli is not None:
+    COMPRESSORS[WS_BODY_PROTOCOL_VERSION_BROTLI] = blivedm.brotli.compress
+
+
+def make_packet(body: bytes, operation, ver=WS_BODY_PROTOCOL_VERSION_NORMAL) -> bytes:
+    header = HEADER_STRUCT.pack(
+        HEADER_STRUCT.size + len(body), HEADER_STRUCT.size, ver, operation, 1
+    )
+    return header + body
+
+
+def make_danmu_msg(index, rnd: random.Random) -> dict:
+    uid = rnd.randint(1, 10 ** 9)
+    timestamp = int(time.time() * 1000) + index
+    return {
+        "cmd": "DANMU_MSG",
+        "info": [
+            [0, 1, 25, 16777215, timestamp, rnd.randint(0, 2 ** 31), 0,
+             "{:08x}".format(uid), 0, 0, 0, "", 0, "{}", "{}"],
+            "弹幕内容{}".format(rnd.randint(0, 10 ** 6)),
+            [uid, "user{}".format(uid % 5000), 0, 0, 0, 10000, 1, ""],
+            [rnd.randint(1, 20), "medal", "anchor", 92613, 6067854, "", 0],
+            [rnd.randint(1, 60), 0, 9868950, ">50000"],
+            ["", ""],
+            0,
+            0,
+            None,
+            {"ts": timestamp // 1000, "ct": "00000000"},
+            0,
+            0,
+        ],
+    }
+
+
+def make_interact_word(index, rnd: random.Random) -> dict:
+    uid = rnd.randint(1, 10 ** 9)
+    return {
+        "cmd": "INTERACT_WORD",
+        "data": {"uid": uid, "uname": "user{}".format(uid % 5000), "msg_type": 1,
+                 "roomid": 92613, "timestamp": int(time.time()), "score": index},
+    }
+
+
+def make_send_gift(index, rnd: random.Random) -> dict:
+    uid = rnd.randint(1, 10 ** 9)
+    return {
+        "cmd": "SEND_GIFT",
+        "data": {
+            "giftName": "辣条", "num": rnd.randint(1, 10), "uname": "user{}".format(uid % 5000),
+            "face": "http://i0.hdslb.com/bfs/face/member/noface.jpg", "guard_level": 0,
+            "uid": uid, "timestamp": int(time.time()), "giftId": 1, "giftType": 0,
+            "action": "投喂", "price": 100, "rnd": str(index), "coin_type": "silver",
+            "total_coin": 100,
+        },
+    }
+
+
+# (generator, weight) of a busy room
+TRAFFIC_MIX = ((make_danmu_msg, 6), (make_interact_word, 3), (make_send_gift, 1))
+
+
+def make_commands(count, seed=0, mix=TRAFFIC_MIX) -> list:
+    rnd = random.Random(seed)
+    makers = [maker for maker, _ in mix]
+    weights = [weight for _, weight in mix]
+    return [rnd.choices(makers, weights)[0](index, rnd) for index in range(count)]
+
+
+def make_frame(commands, ver=WS_BODY_PROTOCOL_VERSION_DEFLATE) -> bytes:
+    """
+    Pack commands into one websocket frame, compressed frames carry all
+    commands in one compressed SEND_MSG_REPLY packet as the server does
+    """
+    packets = b"".join(
+        make_packet(json.dumps(command).encode("utf-8"), Operation.SEND_MSG_REPLY)
+        for command in commands
+    )
+    if ver == WS_BODY_PROTOCOL_VERSION_NORMAL:
+        return packets
+    return make_packet(COMPRESSORS[ver](packets), Operation.SEND_MSG_REPLY, ver)
+
+
+def make_frames(
+    frame_count, commands_per_frame, ver=WS_BODY_PROTOCOL_VERSION_DEFLATE, seed=0
+) -> list:
+    commands = make_commands(frame_count * commands_per_frame, seed)
+    return [
+        make_frame(commands[i: i + commands_per_frame], ver)
+        for i in range(0, len(commands), commands_per_frame)
+    ]
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
@@ -1,46 +1,252 @@
-from xml.dom import minidom as md
-import json
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
+import collections
+import io
 import os
-import cv2
 import sys
+import tempfile
 import requests as rq
 from zipfile import ZipFile
 import uuid
 
+import jsoncodec
+import mongo
+from probe import DEFAULT_CACHE_PATH, DurationCache
+from archive import ArchiveReader, is_archive, read_range
+
+
+def escape_xml(data):
+    """
+    same escaping as minidom, so the output is unchanged
+    """
+    return (
+        data.replace("&", "&amp;")
+        .replace("<", "&lt;")
+        .replace('"', "&quot;")
+        .replace(">", "&gt;")
+    )
+
+
+def write_xml(f, danmaku_data, live_start_time, clip_start_time=0):
+    """
+    stream danmaku data as xml into the text file f, one <d> per danmaku,
+    same layout as minidom toprettyxml(indent="  ")
+    """
+    # TODO add validation to dict data for compatibility
+    f.write('<?xml version="1.0" ?>\n')
+    empty = True
+    for node_data in danmaku_data:
+        if empty:
+            f.write("<i>\n")
+            empty = False
+        appear_time = (
+            int(node_data["timestamp"]) - live_start_time - clip_start_time
+        ) / 1000
+        attr = [
+            appear_time,
+            node_data["mode"],  # 弹幕类型：滚动，底部
+            node_data["font_size"],
+            node_data["color"],
+            node_data["timestamp"],
+            0,
+            0,
+            0,
+        ]
+        attr_str = ",".join([str(i) for i in attr])
+        f.write(
+            '  <d p="{}">{}</d>\n'.format(
+                escape_xml(attr_str), escape_xml(node_data["msg"])
+            )
+        )
+    f.write("<i/>\n" if empty else "</i>\n")
+
+
+class Timeline(object):
+    """
+    danmaku sorted once by timestamp, timestamps kept in a compact array so a
+    time range is found by binary search
+    """
+
+    def __init__(self, danmaku_data):
+        self.danmaku = sorted(danmaku_data, key=lambda x: x["timestamp"])
+        self.timestamps = array("q", (int(i["timestamp"]) for i in self.danmaku))
+
+    def __len__(self):
+        return len(self.danmaku)
+
+    def between(self, start, end) -> list:
+        """
+        danmaku with start < timestamp < end (absolute millisecond)
+        """
+        lo = bisect_right(self.timestamps, start)
+        hi = bisect_left(self.timestamps, end, lo)
+        return self.danmaku[lo:hi]
+
+    def slice(self, start, end) -> "ColumnTimeline":
+        """
+        columns of the danmaku between start and end, cheap to pickle
+        """
+        return ColumnTimeline.from_records(self.between(start, end))
+
+
+class ColumnTimeline(object):
+    """
+    Timeline of the fields the xml needs, kept in typed arrays instead of one
+    dict per danmaku, messages are packed utf-8 in one buffer. Built by
+    streaming records, sorted once when the stream ends
+    """
+
+    def __init__(self):
+        self.timestamps = array("q")
+        self.modes = array("i")
+        self.font_sizes = array("i")
+        self.colors = array("q")
+        self.msg_offsets = array("Q", [0])
+        self.msgs = bytearray()
+
+    @classmethod
+    def from_records(cls, records):
+        timeline = cls()
+        for record in records:
+            timeline.append(record)
+        timeline.sort()
+        return timeline
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def append(self, record):
+        self.timestamps.append(int(record["timestamp"]))
+        self.modes.append(record["mode"])
+        self.font_sizes.append(record["font_size"])
+        self.colors.append(record["color"])
+        self.msgs += record["msg"].encode("utf-8")
+        self.msg_offsets.append(len(self.msgs))
+
+    def sort(self):
+        timestamps = self.timestamps
+        if all(timestamps[i] <= timestamps[i + 1] for i in range(len(timestamps) - 1)):
+            return  # recorded in order, the usual case
+        order = sorted(range(len(timestamps)), key=timestamps.__getitem__)
+        offsets, msgs = self.msg_offsets, self.msgs
+        for name in ("timestamps", "modes", "font_sizes", "colors"):
+            column = getattr(self, name)
+            setattr(self, name, array(column.typecode, (column[i] for i in order)))
+        self.msg_offsets = array("Q", [0])
+        self.msgs = bytearray()
+        for i in order:
+            self.msgs += msgs[offsets[i]:offsets[i + 1]]
+            self.msg_offsets.append(len(self.msgs))
+
+    def between(self, start, end) -> list:
+        """
+        danmaku with start < timestamp < end (absolute millisecond), as dicts
+        of timestamp, mode, font_size, color and msg
+        """
+        lo = bisect_right(self.timestamps, start)
+        hi = bisect_left(self.timestamps, end, lo)
+        return list(self._records(lo, hi))
+
+    def __iter__(self):
+        return self._records(0, len(self))
+
+    def _records(self, lo, hi):
+        offsets, msgs = self.msg_offsets, self.msgs
+        for i in range(lo, hi):
+            yield {
+                "timestamp": self.timestamps[i],
+                "mode": self.modes[i],
+                "font_size": self.font_sizes[i],
+                "color": self.colors[i],
+                "msg": msgs[offsets[i]:offsets[i + 1]].decode("utf-8"),
+            }
+
+    def slice(self, start, end) -> "ColumnTimeline":
+        """
+        a new timeline of the danmaku with start < timestamp < end, it pickles
+        as a few flat buffers
+        """
+        lo = bisect_right(self.timestamps, start)
+        hi = bisect_left(self.timestamps, end, lo)
+        part = ColumnTimeline()
+        for name in ("timestamps", "modes", "font_sizes", "colors"):
+            setattr(part, name, getattr(self, name)[lo:hi])
+        base, top = self.msg_offsets[lo], self.msg_offsets[hi]
+        part.msg_offsets = array("Q", (offset - base for offset in self.msg_offsets[lo:hi + 1]))
+        part.msgs = self.msgs[base:top]
+        return part
+
+
 class DanmakuGene(object):
     danmaku_data_raw = None
     live_start_time = None
     danmaku_data_sorted = None
     result_list = None
+    timeline = None
     video_info_url = "https://api.bilibili.com/x/player/pagelist?bvid={}"
 
-    def __init__(self, danmaku_path):
+    def __init__(self, danmaku_path, load=True, columns=True):
+        """
+        load=False only reads the live start time, use get_danmaku_by_time_indexed then.
+        columns=False keeps every danmaku as a dict in danmaku_data_raw
+        """
         self.danmaku_path = danmaku_path
         self.video_time_pointer = 0
-        self.read_danmaku(self.danmaku_path)
+        if load:
+            self.read_danmaku(self.danmaku_path, columns)
+        else:
+            self.read_live_start_time(self.danmaku_path)
 
-    def read_danmaku(self, path):
+    def read_live_start_time(self, path):
         file_name = os.path.splitext(os.path.split(path)[-1])[0]
-        self.danmaku_data_raw = []
+        if is_archive(path):
+            self.live_start_time = ArchiveReader(path).info["live_start_time"] * 1000
+            return
+        try:  # for compatibility to older danmaku file
+            self.live_start_time = int(file_name.split(".")[0] + "000")
+        except ValueError:
+            with open(path, "r") as f:
+                info = jsoncodec.loads(f.readline())
+            self.live_start_time = info["live_start_time"] * 1000
+
+    def iter_danmaku(self, path):
+        if is_archive(path):
+            yield from ArchiveReader(path)
+            return
         with open(path, "r") as f:
-            try:  # for compatibility to older danmaku file
-                self.live_start_time = int(file_name.split(".")[0] + "000")
-                f.readline()  # skip first line
-            except ValueError:
-                info = json.loads(f.readline())
-                self.live_start_time = info["live_start_time"] * 1000
+            f.readline()  # skip the info line
             for i in f:
-                self.danmaku_data_raw.append(json.loads(i))
+                yield jsoncodec.loads(i)
 
-    def get_video_info(self, path="./video", bias=0) -> list:
+    def read_danmaku(self, path, columns=True):
+        self.read_live_start_time(path)
+        self.danmaku_data_sorted = None
+        if columns:
+            # stream into arrays, no dict is kept per danmaku
+            self.danmaku_data_raw = None
+            self.timeline = ColumnTimeline.from_records(self.iter_danmaku(path))
+        else:
+            self.danmaku_data_raw = list(self.iter_danmaku(path))
+            self.timeline = None
+
+    def get_video_info(
+        self, path="./video", bias=0, cache_path=DEFAULT_CACHE_PATH
+    ) -> list:
+        """
+        durations come from the container header and are cached, see probe.py
+        """
         l = os.listdir(path)
         l.remove(".gitignore")
         l.sort(key=lambda x: int(os.path.splitext(x)[0]))
+        cache = DurationCache(cache_path)
         time_list = [(0, bias)]
-        for i in l:
-            cap = cv2.VideoCapture(path + "/" + i)
-            duration = int((cap.get(7) / cap.get(5)) * 1000)
-            time_list.append((time_list[-1][1], time_list[-1][1] + duration))
+        try:
+            for i in l:
+                duration = cache.duration(path + "/" + i)
+                time_list.append((time_list[-1][1], time_list[-1][1] + duration))
+        finally:
+            cache.save()
         del time_list[0]
         return time_list
 
@@ -64,64 +270,159 @@ class DanmakuGene(object):
         ]
         return data_list
 
+    def get_timeline(self):
+        # sort once, every episode is then a binary search
+        if self.timeline is None:
+            self.timeline = Timeline(self.danmaku_data_raw)
+            self.danmaku_data_sorted = self.timeline.danmaku
+        return self.timeline
+
     def get_danmaku_by_time(self, start_time, end_time) -> list:
         """
         start_time and end_time unit is millisecond
         """
-        # sort row data
-        self.danmaku_data_sorted = sorted(
-            self.danmaku_data_raw, key=lambda x: x["timestamp"]
+        self.result_list = self.get_timeline().between(
+            self.live_start_time + start_time, self.live_start_time + end_time
         )
-        # select
-        sel_list = []
-        for index, i in enumerate(self.danmaku_data_raw):
-            if (i["timestamp"] - self.live_start_time > start_time) and (
-                i["timestamp"] - self.live_start_time < end_time
-            ):
-                sel_list.append(i)
-        self.result_list = sorted(sel_list, key=lambda x: x["timestamp"])
         return self.result_list
 
+    def get_danmaku_by_time_indexed(self, start_time, end_time) -> list:
+        """
+        start_time and end_time unit is millisecond, from the live start.
+        Seek through the time index sidecar instead of loading the whole file
+        """
+        return read_range(
+            self.danmaku_path,
+            self.live_start_time + start_time,
+            self.live_start_time + end_time,
+        )
+
+    def write_xml(self, f, danmaku_data, clip_start_time=0):
+        """
+        stream danmaku data as xml into the text file f, see write_xml
+        """
+        write_xml(f, danmaku_data, self.live_start_time, clip_start_time)
+
     def gene_xml(self, result_path, danmaku_data, clip_start_time=0):
         """
         from danmaku date to xml file
         """
-        # TODO add validation to dict data for compatibility
-        doc = md.Document()
-        node_i = doc.createElement("i")
-        doc.appendChild(node_i)
-        for node_data in danmaku_data:
-            node_d = doc.createElement("d")
-            appear_time = (
-                int(node_data["timestamp"]) - self.live_start_time - clip_start_time
-            ) / 1000
-            attr = [
-                appear_time,
-                node_data["mode"],  # 弹幕类型：滚动，底部
-                node_data["font_size"],
-                node_data["color"],
-                node_data["timestamp"],
-                0,
-                0,
-                0,
-            ]
-            attr_str = ",".join([str(i) for i in attr])
-            node_d.setAttribute("p", attr_str)
-            node_msg = doc.createTextNode(node_data["msg"])
-            node_d.appendChild(node_msg)
-            node_i.appendChild(node_d)
         with open(result_path, "w", encoding="utf-8") as f:
-            f.write(doc.toprettyxml(indent="  "))
+            self.write_xml(f, danmaku_data, clip_start_time)
 
-    def gen_by_video(self, bias=0):
-        l = self.get_video_info(bias=bias)
-        for index, i in enumerate(l):
-            self.gene_xml("./{}.xml".format(index), self.get_danmaku_by_time(*i), i[0])
+    def render_xml(self, start_time, end_time) -> str:
+        """
+        xml text of one episode, start_time and end_time unit is millisecond
+        """
+        buf = io.StringIO()
+        self.write_xml(buf, self.get_danmaku_by_time(start_time, end_time), start_time)
+        return buf.getvalue()
 
-    def gen_by_list(self, time_list, bias=0):
+    def export_episodes(self, time_list, result_paths, workers=None):
+        """
+        write the xml of every (start_time, end_time) in time_list to the path
+        at the same index of result_paths. Every worker process only gets the
+        columns of its episode and streams the xml to its file, workers=None
+        uses every core
+        """
+        timeline = self.get_timeline()
+        # a few episodes in flight per worker, the slices are not all kept at once
+        window = (workers or os.cpu_count() or 1) * 2
+        with ProcessPoolExecutor(workers) as pool:
+            pending = collections.deque()
+            for (start_time, end_time), result_path in zip(time_list, result_paths):
+                if len(pending) >= window:
+                    pending.popleft().result()
+                part = timeline.slice(
+                    self.live_start_time + start_time, self.live_start_time + end_time
+                )
+                pending.append(
+                    pool.submit(
+                        _export_episode, part, self.live_start_time, start_time, result_path
+                    )
+                )
+            for future in pending:
+                future.result()
+
+    def export_zip(self, zip_file, file_names, time_list, workers=1):
+        """
+        one xml entry per episode in zip_file, workers > 1 or None renders the
+        episodes in parallel into temporary files first
+        """
+        if workers == 1:
+            for file_name, (start_time, end_time) in zip(file_names, time_list):
+                danmaku_list = self.get_danmaku_by_time(start_time, end_time)
+                # stream straight into the zip entry, no temp file
+                with zip_file.open(file_name, "w") as entry, io.TextIOWrapper(
+                    entry, encoding="utf-8"
+                ) as text:
+                    self.write_xml(text, danmaku_list, start_time)
+            return
+        with tempfile.TemporaryDirectory(prefix="danmaku-export-") as tmp_dir:
+            paths = [os.path.join(tmp_dir, "{}.xml".format(i)) for i in range(len(time_list))]
+            self.export_episodes(time_list, paths, workers)
+            # added in episode order, so the zip layout is deterministic
+            for file_name, path in zip(file_names, paths):
+                zip_file.write(path, file_name)
+
+    def gen_by_video(self, bias=0, workers=1):
+        self.gen_by_list(self.get_video_info(bias=bias), workers=workers)
+
+    def gen_by_list(self, time_list, bias=0, workers=1):
         l = time_list
-        for index, i in enumerate(l):
-            self.gene_xml("./{}.xml".format(index), self.get_danmaku_by_time(*i), i[0])
+        if workers == 1:
+            for index, i in enumerate(l):
+                self.gene_xml("./{}.xml".format(index), self.get_danmaku_by_time(*i), i[0])
+            return
+        self.export_episodes(l, ["./{}.xml".format(i) for i in range(len(l))], workers)
+
+
+class MongoDanmakuGene(DanmakuGene):
+    """
+    DanmakuGene over a replay record crawled into mongo by live-record.py,
+    every episode is one cursor on the (creator, ts) index, nothing is loaded
+    """
+
+    def __init__(self, rid, client=None):
+        if client is None:
+            if mongo.db.mongo_client is None:
+                mongo.db_connect()
+            client = mongo.db.mongo_client
+        self.client = client
+        self.danmaku_path = None
+        self.video_time_pointer = 0
+        self.info = mongo.find_record(client, rid)
+        if self.info is None:
+            raise ValueError("Record {} is not in mongo".format(rid))
+        # ts of replay danmaku counts from the record start
+        self.live_start_time = self.info["start_timestamp"] * 1000
+
+    def get_danmaku_by_time(self, start_time, end_time):
+        """
+        start_time and end_time unit is millisecond, returns an iterator
+        """
+        for dm in mongo.iter_danmaku(self.client, self.info["_id"], start_time, end_time):
+            yield {
+                "timestamp": self.live_start_time + dm["ts"],
+                "mode": dm["dm_mode"],
+                "font_size": dm["dm_fontsize"],
+                "color": dm["dm_color"],
+                "msg": dm["text"],
+            }
+
+    def export_episodes(self, time_list, result_paths, workers=None):
+        # the client can not be shared with worker processes, and every
+        # episode is a single indexed query anyway
+        for (start_time, end_time), result_path in zip(time_list, result_paths):
+            self.gene_xml(
+                result_path, self.get_danmaku_by_time(start_time, end_time), start_time
+            )
+
+
+def _export_episode(part, live_start_time, clip_start_time, result_path):
+    # runs in an export worker, part is the ColumnTimeline of one episode
+    with open(result_path, "w", encoding="utf-8") as f:
+        write_xml(f, part, live_start_time, clip_start_time)
 
 
 # def proc_bvid(danmaku_file_path, bvid, output_path="./", bias=0):
@@ -142,27 +443,39 @@ class DanmakuGene(object):
 #         )
 #         time_ptr += episode["duration"]
 
-def proc_bvid(danmaku_file_path, bvid, output_path="./", bias=0):
+def proc_bvid(danmaku_file_path, bvid, output_path="./", bias=0, workers=1):
+    """
+    workers > 1 or None renders the episodes in parallel, see DanmakuGene.export_zip
+    """
     gen_obj = DanmakuGene(danmaku_file_path)
     video_info = gen_obj.get_video_info_from_web(bvid)
     sorted_info = sorted(video_info, key=lambda x: x["page"])
+    time_list = []
+    time_ptr = bias
     for ep in sorted_info:
         ep["duration"] = ep["duration"] * 1000
-    time_ptr = bias
+        time_list.append((time_ptr, time_ptr + ep["duration"]))
+        time_ptr += ep["duration"]
+    file_names = [
+        "{}-{}-{}.xml".format(bvid, episode["page"], episode["part"])
+        for episode in sorted_info
+    ]
     archive_file_name = uuid.uuid1().hex
     with ZipFile("{}/{}".format(output_path, archive_file_name), "w") as f:
-        for episode in sorted_info:
-            danmaku_list = gen_obj.get_danmaku_by_time(
-                time_ptr, time_ptr + episode["duration"]
-            )
-            file_name = "./{}-{}-{}.xml".format(bvid, episode["page"], episode["part"])
-            gen_obj.gene_xml(file_name, danmaku_list, time_ptr)
-            time_ptr += episode["duration"]
-            f.write(file_name)
-            os.remove(file_name)
+        gen_obj.export_zip(f, file_names, time_list, workers)
     return archive_file_name
 
 
+def proc_clip(danmaku_file_path, start_time, end_time, result_path):
+    """
+    start_time and end_time unit is millisecond, from the live start
+    """
+    gen_obj = DanmakuGene(danmaku_file_path, load=False)
+    danmaku_list = gen_obj.get_danmaku_by_time_indexed(start_time, end_time)
+    gen_obj.gene_xml(result_path, danmaku_list, start_time)
+    return result_path
+
+
 def test():
     hex = proc_bvid("./test/1605680870.json", "BV1Gz4y1y7wn", "./test")
     print(hex)
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import enum
+import logging
+import os
+import time
+from typing import Callable, List, Optional, Tuple
+
+import jsoncodec
+
+logger = logging.getLogger(__name__)
+
+
+class DurabilityPolicy(enum.Enum):
+    FLUSH = "flush"  # hand the data to the os after every commit, never fsync
+    FSYNC = "fsync"  # fsync at most every fsync_interval milliseconds
+    FSYNC_ON_CLOSE = "fsync_on_close"  # fsync only once when the file is closed
+
+
+def parse_durability(value: str) -> Tuple[DurabilityPolicy, int]:
+    """
+    @description: Parse "flush", "fsync_on_close" or "fsync:<ms>" into (policy, interval)
+    """
+    name, _, interval = value.partition(":")
+    policy = DurabilityPolicy(name.strip().lower())
+    return policy, int(interval) if interval else 1000
+
+
+class GroupCommitWriter:
+    """
+    @description: Line writer that commits buffered lines in groups, a commit is
+    triggered by the message count, the buffered bytes or the age of the oldest
+    buffered line, whichever comes first. Subclasses change the file layout
+    through file_mode, file_encoding, _size and _encode
+    """
+
+    file_mode = "a"
+    file_encoding = None  # platform default, as the danmaku files always used
+
+    def __init__(
+        self,
+        path,
+        max_count=512,
+        max_bytes=64 * 1024,
+        max_delay=1.0,
+        policy=DurabilityPolicy.FLUSH,
+        fsync_interval=1000,
+        loop=None,
+        timers=True,
+    ):
+        """
+        :param path: file path, opened in append mode
+        :param max_count: commit when this many lines are buffered
+        :param max_bytes: commit when this many characters are buffered
+        :param max_delay: commit when the oldest buffered line is this old (second)
+        :param policy: durability policy
+        :param fsync_interval: min interval between two fsync of FSYNC policy (millisecond)
+        :param loop: event loop for the commit timers
+        :param timers: False when the owner drives commits with tick, e.g. from
+            a thread where the event loop timers can not be used
+        """
+        self.path = path
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.policy = policy
+        self.fsync_interval = fsync_interval / 1000
+        self.timers = timers
+        self._loop = loop if loop is not None or not timers else asyncio.get_event_loop()
+        self._file = open(path, self.file_mode, encoding=self.file_encoding)
+
+        self._buffer: List = []
+        self._buffer_bytes = 0
+        self._buffered_at = 0.0  # when the oldest buffered line came
+        self._unsynced = 0  # committed lines not fsynced yet
+        self._last_fsync = time.monotonic()
+        self._commit_handle = None
+        self._fsync_handle = None
+        self.closed = False
+        # called with the seconds spent writing and flushing each commit
+        self.on_commit: Optional[Callable[[float], None]] = None
+
+    def tell(self):
+        return self._file.tell()
+
+    @property
+    def pending(self):
+        """
+        Lines still in the user space buffer, lost if the process crashes
+        """
+        return len(self._buffer)
+
+    @property
+    def max_loss(self):
+        """
+        Upper bound of lines lost if the machine crashes right now
+        """
+        return self.pending + self._unsynced
+
+    def write_header(self, info: dict):
+        """
+        @description: Write the info line of a blank file
+        """
+        self._file.write(jsoncodec.dumps(info) + "\n")
+        self._file.flush()
+
+    def write_record(self, record: dict):
+        self.write(jsoncodec.dumps(record) + "\n")
+
+    def _size(self, item) -> int:
+        return len(item)
+
+    def _encode(self, items: list):
+        return "".join(items)
+
+    def write(self, item):
+        if self.closed:
+            raise ValueError("write to closed writer {}".format(self.path))
+        if not self._buffer:
+            self._buffered_at = time.monotonic()
+        self._buffer.append(item)
+        self._buffer_bytes += self._size(item)
+        if len(self._buffer) >= self.max_count or self._buffer_bytes >= self.max_bytes:
+            self.commit()
+        elif self._commit_handle is None and self.timers:
+            self._commit_handle = self._loop.call_later(self.max_delay, self._on_timer)
+
+    def _on_timer(self):
+        self._commit_handle = None
+        try:
+            self.commit()
+        except IOError as e:
+            logger.error("Fail to commit danmaku to {}, detail: {}".format(self.path, e))
+
+    def commit(self):
+        if self._commit_handle is not None:
+            self._commit_handle.cancel()
+            self._commit_handle = None
+        if not self._buffer:
+            return
+        count = len(self._buffer)
+        time_s = time.perf_counter()
+        # a failed write keeps the buffer, the next commit retries it
+        self._file.write(self._encode(self._buffer))
+        self._file.flush()
+        if self.on_commit is not None:
+            self.on_commit(time.perf_counter() - time_s)
+        self._buffer.clear()
+        self._buffer_bytes = 0
+        self._unsynced += count
+
+        if self.policy is DurabilityPolicy.FSYNC:
+            wait = self.fsync_interval - (time.monotonic() - self._last_fsync)
+            if wait <= 0:
+                self.fsync()
+            elif self._fsync_handle is None and self.timers:
+                self._fsync_handle = self._loop.call_later(wait, self._on_fsync_timer)
+        logger.debug(
+            "Commit {} lines to {}, at most {} lines at risk".format(
+                count, self.path, self.max_loss
+            )
+        )
+
+    def tick(self):
+        """
+        @description: Commit, and fsync when the FSYNC interval is due, what the
+        timers would have done, for owners that set timers=False
+        """
+        if self._buffer and time.monotonic() - self._buffered_at >= self.max_delay:
+            self.commit()
+        if (
+            self.policy is DurabilityPolicy.FSYNC
+            and self._unsynced
+            and time.monotonic() - self._last_fsync >= self.fsync_interval
+        ):
+            self.fsync()
+
+    def _on_fsync_timer(self):
+        self._fsync_handle = None
+        try:
+            self.fsync()
+        except OSError as e:
+            logger.error("Fail to fsync {}, detail: {}".format(self.path, e))
+
+    def fsync(self):
+        if self._fsync_handle is not None:
+            self._fsync_handle.cancel()
+            self._fsync_handle = None
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_fsync = time.monotonic()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.commit()
+            if self.policy is not DurabilityPolicy.FLUSH:
+                self.fsync()
+        finally:
+            if self._fsync_handle is not None:
+                self._fsync_handle.cancel()
+                self._fsync_handle = None
+            self._file.close()
+            self.closed = True
+        logger.info(
+            "Writer {} closed, at most {} lines at risk".format(self.path, self.max_loss)
+        )